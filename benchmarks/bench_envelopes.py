@@ -0,0 +1,141 @@
+'''Micro-benchmark of per-envelope build cost: the original
+template-per-call builders versus the precompiled fragment builders
+in oncorelib.core.
+
+Usage: python benchmarks/bench_envelopes.py [iterations]
+'''
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+from string import Template
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from oncorelib import core
+
+REG_DATA = {'primary-identifier': u'1234567', 'context': u'ctx',
+            'study-site': u'Main Campus', 'protocol-num': u'AAAA1234',
+            'last-name': u'Doe', 'first-name': u'Jane',
+            'birthdate': u'1970-01-01', 'gender': u'Female',
+            'races': [u'White', u'Asian', u'Unknown'],
+            'ethnicity': u'Unknown'}
+
+#------------------------------------------------------------------------------
+# builders as they were before precompilation
+
+def legacy_protocol_xml(protocol_num):
+  return (u'''
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+                  xmlns:data="http://data.service.opas.percipenz.com">
+   <soapenv:Header/>
+   <soapenv:Body>
+      <data:ProtocolSearchCriteria>
+         <!--type: string-->
+         <protocolNo>{PROTOCOL_NUM}</protocolNo>
+      </data:ProtocolSearchCriteria>
+   </soapenv:Body>
+</soapenv:Envelope>
+  ''').format(PROTOCOL_NUM=protocol_num)
+
+def legacy_subject_data_xml(primary_id):
+  return (u'''
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+                  xmlns:ser="http://service.opas.percipenz.com">
+   <soapenv:Header/>
+   <soapenv:Body>
+      <ser:SubjectSearchData>
+         <!--type: string-->
+         <PrimaryIdentifier>{PRIMARY_ID}</PrimaryIdentifier>
+      </ser:SubjectSearchData>
+   </soapenv:Body>
+</soapenv:Envelope>
+  ''').format(PRIMARY_ID=primary_id)
+
+def legacy_registration_xml(reg_data, subject_num=None):
+  if not core.verify_reg_data(reg_data):
+    raise ValueError
+  op_element = (u'ProtocolExistingSubjectRegistrationData' if subject_num
+                else u'ProtocolNewSubjectRegistrationData')
+  subject_num_element = (u'<SubjectNo>' + unicode(subject_num) + u'</SubjectNo>'
+                         if subject_num else '')
+  race_elements = reduce(lambda xml, race: xml + u'<Race>' + race + u'</Race>',
+                         reg_data['races'],
+                         '')
+  xml = Template(u'''
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+                  xmlns:sub="http://data.service.opas.percipenz.com/subject">
+   <soapenv:Header/>
+   <soapenv:Body>
+      <sub:$OP_ELEMENT>
+         <sub:ProtocolSubjectRegistrationData>
+            <Context>$CONTEXT</Context>
+            <ProtocolSubject>
+               <ProtocolNo>$PROTOCOL_NUM</ProtocolNo>
+               <StudySite>$STUDY_SITE</StudySite>
+               <Subject>
+                  <PrimaryIdentifier>$PRIMARY_IDENTIFIER</PrimaryIdentifier>
+                  $SUBJECT_NUM_ELEMENT
+                  $RACE_ELEMENTS
+                  <LastName>$LAST_NAME</LastName>
+                  <FirstName>$FIRST_NAME</FirstName>
+                  <BirthDate>$BIRTHDATE</BirthDate>
+                  <Gender>$GENDER</Gender>
+                  <Ethnicity>$ETHNICITY</Ethnicity>
+               </Subject>
+            </ProtocolSubject>
+         </sub:ProtocolSubjectRegistrationData>
+      </sub:$OP_ELEMENT>
+   </soapenv:Body>
+</soapenv:Envelope>
+      ''')
+  return xml.substitute(OP_ELEMENT=op_element,
+                        CONTEXT=reg_data['context'],
+                        PROTOCOL_NUM=reg_data['protocol-num'],
+                        STUDY_SITE=reg_data['study-site'],
+                        PRIMARY_IDENTIFIER=reg_data['primary-identifier'],
+                        SUBJECT_NUM_ELEMENT=subject_num_element,
+                        RACE_ELEMENTS=race_elements,
+                        LAST_NAME=reg_data['last-name'],
+                        FIRST_NAME=reg_data['first-name'],
+                        BIRTHDATE=reg_data['birthdate'],
+                        GENDER=reg_data['gender'],
+                        ETHNICITY=reg_data['ethnicity'])
+
+#------------------------------------------------------------------------------
+
+CASES = [
+  ('get_protocol',
+   lambda: legacy_protocol_xml(u'AAAA1234'),
+   lambda: core._protocol_xml(u'AAAA1234')),
+  ('get_subject_data',
+   lambda: legacy_subject_data_xml(u'1234567'),
+   lambda: core._subject_data_xml(u'1234567')),
+  ('register (new)',
+   lambda: legacy_registration_xml(REG_DATA),
+   lambda: core._registration_xml(REG_DATA)),
+  ('register (existing)',
+   lambda: legacy_registration_xml(REG_DATA, 42),
+   lambda: core._registration_xml(REG_DATA, 42)),
+]
+
+def _same_document(a, b):
+  # Ignores the whitespace and comments the old templates carried.
+  return core.xmltodict.parse(a) == core.xmltodict.parse(b)
+
+def main(iterations=100000):
+  print('%-22s %12s %12s %8s' % ('envelope', 'before (us)', 'after (us)',
+                                  'speedup'))
+  for name, before, after in CASES:
+    assert _same_document(before(), after()), name
+    t_before = min(timeit.repeat(before, number=iterations, repeat=3))
+    t_after = min(timeit.repeat(after, number=iterations, repeat=3))
+    print('%-22s %12.2f %12.2f %7.1fx' % (name,
+                                          t_before / iterations * 1e6,
+                                          t_after / iterations * 1e6,
+                                          t_before / t_after))
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,132 @@
+'''Throughput benchmark of oncorelib against the local mock OnCore
+server (benchmarks/mock_oncore.py).
+
+Runs each scenario in its own process and reports calls/second,
+p50/p99 per-call latency and peak RSS:
+  o serial: get_subject_data in a loop
+  o threaded: get_subject_data from a pool of threads
+  o batch: get_subject_data_many
+  o async: AsyncClient handles
+  o processes: get_subjects_parallel (parsing in a process pool)
+  o protocol: get_protocol in a loop (larger responses)
+
+Usage: python benchmarks/bench_throughput.py [--calls N] [--workers N]
+         [--latency SECONDS] [--sites N] [--attachment-bytes N]
+         [--no-parse] [scenario ...]
+'''
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oncorelib
+import mock_oncore
+
+def _ids(n):
+  return [u'MRN%07d' % i for i in range(n)]
+
+def serial(spec, args, use):
+  for primary_id in _ids(args.calls):
+    use(oncorelib.get_subject_data(spec, primary_id))
+
+def threaded(spec, args, use):
+  pool = ThreadPool(args.workers)
+  for result in pool.imap_unordered(
+      lambda primary_id: oncorelib.get_subject_data(spec, primary_id),
+      _ids(args.calls)):
+    use(result)
+  pool.close()
+
+def batch(spec, args, use):
+  for _, result, error in oncorelib.get_subject_data_many(
+      spec, _ids(args.calls), max_workers=args.workers):
+    if error is not None:
+      raise error
+    use(result)
+
+def async_client(spec, args, use):
+  hooks = oncorelib.get_client(spec).hooks
+  with oncorelib.AsyncClient(spec, max_in_flight=args.workers,
+                             hooks=hooks) as client:
+    handles = [client.get_subject_data(primary_id)
+               for primary_id in _ids(args.calls)]
+    for handle in handles:
+      use(handle.get())
+
+def processes(spec, args, use):
+  for _, subject, error in oncorelib.get_subjects_parallel(
+      spec, _ids(args.calls), max_workers=args.workers):
+    if error is not None:
+      raise error
+
+def protocol(spec, args, use):
+  for i in range(args.calls):
+    use(oncorelib.get_protocol(spec, u'PROT%04d' % (i % 50)))
+
+SCENARIOS = [('serial', serial), ('threaded', threaded), ('batch', batch),
+             ('async', async_client), ('processes', processes),
+             ('protocol', protocol)]
+
+def _percentile(values, q):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+def _run(name, fn, spec, args, queue):
+  latencies = []
+  oncorelib.get_client(spec).hooks.append(lambda event: latencies.append(event['seconds'])
+                      if event['phase'] == 'total' else None)
+  use = ((lambda result: result['structured-data']) if args.parse
+         else (lambda result: None))
+  started = time.time()
+  fn(spec, args, use)
+  elapsed = time.time() - started
+  queue.put({'scenario': name,
+             'calls/s': len(latencies) / elapsed,
+             'p50 ms': _percentile(latencies, 0.5) * 1000,
+             'p99 ms': _percentile(latencies, 0.99) * 1000,
+             'peak rss MB': resource.getrusage(
+               resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('scenarios', nargs='*',
+                      default=[name for name, _ in SCENARIOS])
+  parser.add_argument('--calls', type=int, default=1000)
+  parser.add_argument('--workers', type=int, default=16)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--sites', type=int, default=20)
+  parser.add_argument('--attachment-bytes', type=int, default=0)
+  parser.add_argument('--no-parse', dest='parse', action='store_false',
+                      help="don't touch structured-data of each result")
+  args = parser.parse_args()
+  server, spec = mock_oncore.start(latency=args.latency, sites=args.sites,
+                                   attachment_bytes=args.attachment_bytes)
+  spec['pool-maxsize'] = args.workers
+  print('%-10s %10s %9s %9s %12s' % ('scenario', 'calls/s', 'p50 ms',
+                                      'p99 ms', 'peak rss MB'))
+  for name, fn in SCENARIOS:
+    if name not in args.scenarios:
+      continue
+    queue = Queue()
+    process = Process(target=_run, args=(name, fn, spec, args, queue))
+    process.start()
+    process.join()
+    if process.exitcode:
+      print('%-10s failed (exit code %d)' % (name, process.exitcode))
+      continue
+    row = queue.get()
+    print('%-10s %10.1f %9.2f %9.2f %12.1f' % (
+      row['scenario'], row['calls/s'], row['p50 ms'], row['p99 ms'],
+      row['peak rss MB']))
+  server.shutdown()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,162 @@
+'''Local stand-in for the OnCore SOAP endpoint, for benchmarking.
+
+Answers ProtocolSearchCriteria, SubjectSearchData and registration
+envelopes with multipart (MTOM-style) responses shaped like OnCore's,
+with configurable latency and payload size. Not a faithful
+reimplementation of OnCore; just enough for oncorelib to exercise its
+full request/decode/parse path.
+
+Usage: python benchmarks/mock_oncore.py [--port N] [--latency SECONDS]
+                                        [--sites N] [--attachment-bytes N]
+'''
+from __future__ import division
+from __future__ import print_function
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import argparse
+import random
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+
+BOUNDARY = 'uuid:8f1c2a0e-mock-oncore'
+
+ENVELOPE = (
+  '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"'
+  ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+  '<soap:Body>%s</soap:Body></soap:Envelope>')
+
+SUBJECT = (
+  '<ns7:Subject xmlns:ns7="http://data.service.opas.percipenz.com/subject">'
+  '<PrimaryIdentifier>%(id)s</PrimaryIdentifier>'
+  '<SubjectNo>%(num)d</SubjectNo>'
+  '<FirstName>Jane</FirstName><LastName>Doe%(num)d</LastName>'
+  '<BirthDate>1970-01-01</BirthDate><Gender>Female</Gender>'
+  '<Race>White</Race><Race>Asian</Race>'
+  '<Ethnicity>Non-Hispanic</Ethnicity></ns7:Subject>')
+
+NIL_SUBJECT = ('<ns7:Subject xmlns:ns7='
+               '"http://data.service.opas.percipenz.com/subject"'
+               ' xsi:nil="true"/>')
+
+PROTOCOL = (
+  '<ns2:Protocol xmlns:ns2="http://data.service.opas.percipenz.com">'
+  '<ProtocolNo>%(no)s</ProtocolNo>'
+  '<Title>A Randomized Phase II Study of Something Promising in %(no)s'
+  '</Title>'
+  '<ShortTitle>Study %(no)s</ShortTitle>'
+  '<Status>OPEN TO ACCRUAL</Status>'
+  '%(sites)s%(staff)s</ns2:Protocol>')
+
+SITE = ('<StudySite><Name>Site %d</Name><Status>OPEN TO ACCRUAL</Status>'
+        '</StudySite>')
+
+STAFF = ('<ProtocolStaff><LastName>Investigator%d</LastName>'
+         '<FirstName>Pat</FirstName><Role>Sub-Investigator</Role>'
+         '</ProtocolStaff>')
+
+REGISTRATION = (
+  '<ns2:ProtocolSubjectRegistrationResponse'
+  ' xmlns:ns2="http://data.service.opas.percipenz.com/subject">'
+  '<SubjectNo>%d</SubjectNo></ns2:ProtocolSubjectRegistrationResponse>')
+
+_TAG_RE = re.compile(r'<(?:\w+:)?(%s)>(.*?)<' % '|'.join(
+  ['protocolNo', 'PrimaryIdentifier']))
+
+class Settings(object):
+
+  def __init__(self, latency=0.0, sites=5, attachment_bytes=0,
+               nil_fraction=0.0):
+    self.latency = latency
+    self.sites = sites
+    self.attachment_bytes = attachment_bytes
+    self.nil_fraction = nil_fraction
+
+def _body(settings, request):
+  if 'Registration' in request:
+    return REGISTRATION % random.randint(1, 10 ** 6)
+  match = _TAG_RE.search(request)
+  value = match.group(2) if match else ''
+  if match and match.group(1) == 'protocolNo':
+    return PROTOCOL % {
+      'no': value,
+      'sites': ''.join(SITE % i for i in range(settings.sites)),
+      'staff': ''.join(STAFF % i for i in range(settings.sites * 2))}
+  if random.random() < settings.nil_fraction:
+    return NIL_SUBJECT
+  return SUBJECT % {'id': value, 'num': abs(hash(value)) % 10 ** 6}
+
+def _multipart(xml, attachment_bytes):
+  parts = ['--%s\r\n'
+           'Content-Type: application/xop+xml; charset=UTF-8;'
+           ' type="text/xml"\r\n'
+           'Content-Transfer-Encoding: binary\r\n'
+           'Content-ID: <root.message@cxf.apache.org>\r\n\r\n'
+           '%s\r\n' % (BOUNDARY, xml)]
+  if attachment_bytes:
+    parts.append('--%s\r\nContent-Type: application/octet-stream\r\n'
+                 'Content-ID: <attachment>\r\n\r\n%s\r\n'
+                 % (BOUNDARY, 'x' * attachment_bytes))
+  parts.append('--%s--\r\n' % BOUNDARY)
+  return ''.join(parts)
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  wbufsize = 64 * 1024  # write status, headers and body in one go
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    settings = self.server.settings
+    request = self.rfile.read(int(self.headers.get('content-length', 0)))
+    if settings.latency:
+      time.sleep(settings.latency)
+    xml = ENVELOPE % _body(settings, request)
+    data = _multipart(xml, settings.attachment_bytes)
+    self.send_response(200)
+    self.send_header('Content-Type',
+                     'multipart/related; type="application/xop+xml";'
+                     ' boundary="%s"; start="<root.message@cxf.apache.org>";'
+                     ' start-info="text/xml"' % BOUNDARY)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+class Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  request_queue_size = 128
+
+def start(port=0, **settings):
+  '''Starts the mock server on a background thread. Returns
+  (server, spec) where spec points oncorelib at it.'''
+  server = Server(('127.0.0.1', port), Handler)
+  server.settings = Settings(**settings)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  spec = {'user': 'bench', 'password': 'bench',
+          'service-url': 'http://127.0.0.1:%d/opas/OpasService'
+                         % server.server_address[1]}
+  return server, spec
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--latency', type=float, default=0.0)
+  parser.add_argument('--sites', type=int, default=5)
+  parser.add_argument('--attachment-bytes', type=int, default=0)
+  args = parser.parse_args()
+  server, spec = start(args.port, latency=args.latency, sites=args.sites,
+                       attachment_bytes=args.attachment_bytes)
+  print('mock OnCore listening; spec: %r' % spec)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == '__main__':
+  main()
@@ -1,2 +1,12 @@
 from core import *
-
+from batch import *
+from asyncclient import *
+from cache import *
+from retry import *
+from ratelimit import *
+from breaker import *
+from metrics import *
+from transport import *
+from reconcile import *
+from mirror import *
+from coalesce import *
@@ -0,0 +1,263 @@
+from __future__ import division
+from __future__ import print_function
+
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from xml.parsers import expat
+
+import requests
+
+from core import ResponseError, decode_response, get_client, to_subject
+from core import verify_reg_data
+from core import _registration_xml, _subject_data_xml
+
+__all__ = ['get_subject_data_many', 'decode_subject', 'get_subjects_parallel',
+           'register_subjects', 'ensure_registered']
+
+#------------------------------------------------------------------------------
+# concurrent batch calls
+
+DEFAULT_MAX_WORKERS = 8
+
+def _guarded(fn):
+  '''Wraps fn(arg) so that it returns (arg, result, error) instead of
+  raising; lets one failure be reported without aborting a batch.'''
+  def run(arg):
+    try:
+      return (arg, fn(arg), None)
+    except Exception as e:
+      return (arg, None, e)
+  return run
+
+def _fan_out(fn, args, max_workers, ordered):
+  '''Applies fn over args on a bounded thread pool and yields
+  (arg, result, error) tuples, either in input order or as they
+  complete.'''
+  pool = ThreadPool(max_workers)
+  try:
+    mapper = pool.imap if ordered else pool.imap_unordered
+    for outcome in mapper(_guarded(fn), args):
+      yield outcome
+  finally:
+    pool.terminate()
+
+def get_subject_data_many(spec, primary_ids, max_workers=DEFAULT_MAX_WORKERS,
+                          ordered=False):
+  '''Calls get_subject_data for each of primary_ids over a bounded
+  thread pool sharing the spec's default client (and so its connection
+  pool; keep max_workers at or below the spec's pool-maxsize).
+  Yields (primary_id, subject_data, error) tuples; error is None on
+  success, otherwise it's the exception raised for that id and
+  subject_data is None. Results come back as they complete unless
+  ordered is True, in which case they follow the order of primary_ids.
+  '''
+  client = get_client(spec)
+  return _fan_out(client.get_subject_data, primary_ids, max_workers, ordered)
+
+#------------------------------------------------------------------------------
+# split I/O and parsing
+
+def decode_subject(raw):
+  '''Default decoder for get_subjects_parallel: output of
+  Client.call_raw -> Subject.'''
+  return to_subject(decode_response(*raw))
+
+def _collect(primary_id, pending):
+  try:
+    return (primary_id, pending.get(), None)
+  except Exception as e:
+    return (primary_id, None, e)
+
+def get_subjects_parallel(spec, primary_ids, max_workers=DEFAULT_MAX_WORKERS,
+                          processes=None, decode=decode_subject,
+                          process_pool=None):
+  '''Like get_subject_data_many, but only the HTTP round-trips happen on
+  threads; raw responses are handed to a process pool for multipart
+  decoding and XML parsing, so throughput scales with cores instead of
+  being capped by one interpreter's GIL.
+  decode is applied in the worker processes to each (status code,
+  content type, body) triple; it must be a picklable top-level function
+  and its result is what's sent back, so it should be compact. The
+  default returns a Subject.
+  A process_pool (multiprocessing.Pool) may be passed in to reuse it
+  across batches; otherwise one with the given number of processes is
+  started (before any threads) and torn down at the end.
+  Yields (primary_id, decoded, error) tuples, roughly as they complete.
+  '''
+  own_pool = process_pool is None
+  if own_pool:
+    process_pool = Pool(processes)
+  client = get_client(spec)
+  def fetch(primary_id):
+    return client.call_raw(_subject_data_xml(primary_id), 'get_subject_data')
+  max_pending = 4 * max_workers  # bounds raw bodies held in memory
+  pending = deque()  # (primary_id, AsyncResult), oldest first
+  try:
+    for primary_id, raw, error in _fan_out(fetch, primary_ids, max_workers,
+                                           False):
+      if error is not None:
+        yield (primary_id, None, error)
+        continue
+      pending.append((primary_id, process_pool.apply_async(decode, (raw,))))
+      while pending and (pending[0][1].ready() or len(pending) > max_pending):
+        yield _collect(*pending.popleft())
+    while pending:
+      yield _collect(*pending.popleft())
+  finally:
+    if own_pool:
+      process_pool.terminate()
+
+#------------------------------------------------------------------------------
+# bulk registration
+
+def _soap_fault(result):
+  '''Returns the Fault element's contents (as structured data) if the
+  response carries a SOAP fault, otherwise None.'''
+  try:
+    body = result['structured-data']['soap:Envelope']['soap:Body']
+  except (KeyError, TypeError, ValueError, expat.ExpatError):
+    return None
+  for key, value in (body or {}).items():
+    if key.split(':')[-1] == 'Fault':
+      return value
+  return None
+
+def _outcome(index, reg_data, result=None, error=None):
+  '''Classifies one registration as 'success', 'invalid', 'soap-fault',
+  'http-error' or 'error'.'''
+  if error is not None:
+    status = ('http-error' if isinstance(error, requests.RequestException)
+              else 'error')
+  elif result is None:
+    status = 'invalid'
+  elif _soap_fault(result) is not None:
+    status, error = 'soap-fault', _soap_fault(result)
+  elif result['status-code'] >= 400:
+    status = 'http-error'
+  else:
+    status = 'success'
+  return {'index': index, 'reg-data': reg_data, 'status': status,
+          'result': result, 'error': error}
+
+def register_subjects(spec, reg_data_items, subject_nums=None,
+                      max_workers=DEFAULT_MAX_WORKERS):
+  '''Registers many subjects, each as register_subject_to_protocol
+  would, over a bounded thread pool sharing the spec's default client.
+  All records are checked with verify_reg_data before anything is sent;
+  invalid ones are reported and skipped. subject_nums optionally maps
+  primary identifiers to existing OnCore subject numbers.
+  Returns a list, in input order, of outcome maps with keys:
+    o 'index': position in reg_data_items
+    o 'reg-data': the record
+    o 'status': 'success', 'invalid', 'soap-fault', 'http-error' or
+       'error' (any other exception)
+    o 'result': result of _call, if a response was received
+    o 'error': the fault contents or exception, if any
+  A failure never stops the rest of the batch.
+  '''
+  subject_nums = subject_nums or {}
+  outcomes = []
+  pending = []  # (index, reg_data, envelope)
+  for index, reg_data in enumerate(reg_data_items):
+    if not verify_reg_data(reg_data):
+      outcomes.append(_outcome(index, reg_data))
+      continue
+    subject_num = subject_nums.get(reg_data['primary-identifier'])
+    pending.append((index, reg_data,
+                    _registration_xml(reg_data, subject_num)))
+  client = get_client(spec)
+  def submit(item):
+    return client.call(item[2], 'register_subject_to_protocol',
+                       bypass_cache=True)
+  for item, result, error in _fan_out(submit, pending, max_workers, False):
+    outcomes.append(_outcome(item[0], item[1], result, error))
+  outcomes.sort(key=lambda outcome: outcome['index'])
+  return outcomes
+
+def _lookup_subject_nums(spec, primary_ids, max_workers, bypass_cache=False):
+  '''Looks up primary_ids concurrently. Returns (map of primary id ->
+  SubjectNo, or None if OnCore has no record; map of primary id ->
+  exception for lookups that failed). A record without a SubjectNo
+  counts as failed, as it can't be registered as existing.'''
+  client = get_client(spec)
+  def lookup(primary_id):
+    return client.call(_subject_data_xml(primary_id), 'get_subject_data',
+                       bypass_cache=bypass_cache)
+  subject_nums = {}
+  errors = {}
+  for primary_id, subject_data, error in _fan_out(lookup, primary_ids,
+                                                   max_workers, False):
+    if error is None:
+      try:
+        subject = to_subject(subject_data, drop_raw=True)
+        if subject.exists and subject.subject_num is None:
+          raise ResponseError('OnCore subject has no SubjectNo')
+      except (KeyError, expat.ExpatError) as e:
+        error = e
+    if error is not None:
+      errors[primary_id] = error
+    elif subject.exists:
+      subject_nums[primary_id] = subject.subject_num
+    else:
+      subject_nums[primary_id] = None
+  return subject_nums, errors
+
+def _lookup_error(index, reg_data, error):
+  outcome = _outcome(index, reg_data, error=error)
+  outcome['status'] = 'lookup-error'
+  return outcome
+
+def ensure_registered(spec, reg_data_batch, max_workers=DEFAULT_MAX_WORKERS):
+  '''Lookup-then-register workflow: looks up each distinct primary
+  identifier in the batch once (concurrently), then registers every
+  record, using the existing-subject registration for those that already
+  have an OnCore record and the new-subject registration otherwise.
+  A primary identifier without a record that appears in several records
+  (e.g. for several protocols) is registered as new only once: the rest
+  wait for that registration, a fresh lookup of its SubjectNo, and then
+  go in as existing. Should that registration fail, the next record is
+  tried as new.
+  Returns outcomes as register_subjects does, indexed against
+  reg_data_batch. Records whose lookup failed (an exception, a non-200
+  status such as a SOAP fault, a response that couldn't be read, or an
+  existing subject without a SubjectNo) are not registered, as that
+  could create a duplicate subject; they get status 'lookup-error' with
+  the exception as 'error'.
+  '''
+  reg_data_batch = list(reg_data_batch)
+  outcomes = []
+  pending = {}  # primary id -> [(index, reg_data)] not yet registered
+  for index, reg_data in enumerate(reg_data_batch):
+    if not verify_reg_data(reg_data):
+      outcomes.append(_outcome(index, reg_data))
+    else:
+      pending.setdefault(reg_data['primary-identifier'], []).append(
+        (index, reg_data))
+  subject_nums, errors = _lookup_subject_nums(spec, list(pending),
+                                              max_workers)
+  while pending:
+    for primary_id, error in errors.items():
+      for index, reg_data in pending.pop(primary_id, ()):
+        outcomes.append(_lookup_error(index, reg_data, error))
+    batch = []  # (index, reg_data) registered this round
+    for primary_id, items in pending.items():
+      if subject_nums[primary_id] is None:
+        batch.append(items.pop(0))  # one new-subject registration at a time
+      else:
+        batch.extend(items)
+        del items[:]
+    for outcome in register_subjects(spec, [item[1] for item in batch],
+                                     subject_nums, max_workers):
+      outcome['index'] = batch[outcome['index']][0]
+      outcomes.append(outcome)
+    pending = dict((primary_id, items) for primary_id, items in pending.items()
+                   if items)
+    # Whatever became of the new-subject registrations (even a failed
+    # one may have created the subject), ask OnCore afresh.
+    if pending:
+      found, errors = _lookup_subject_nums(spec, list(pending), max_workers,
+                                           bypass_cache=True)
+      subject_nums.update(found)
+  outcomes.sort(key=lambda outcome: outcome['index'])
+  return outcomes
@@ -0,0 +1,145 @@
+from __future__ import division
+from __future__ import print_function
+
+from collections import deque
+import threading
+import time
+
+import requests
+
+__all__ = ['CircuitOpenError', 'CircuitBreaker']
+
+#------------------------------------------------------------------------------
+# circuit breaker
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitOpenError(Exception):
+  '''Raised instead of calling OnCore while the circuit is open.'''
+
+class CircuitBreaker(object):
+  '''Stops calling the OnCore endpoint once it looks down, so workers
+  fail fast instead of piling up on dead sockets.
+  The circuit opens after failure_threshold consecutive failures, or, if
+  failure_rate is set, once at least that fraction of the last window
+  requests failed. While open, calls raise CircuitOpenError. After
+  reset_timeout seconds the circuit is half-open: a single probe request
+  is let through, and its outcome closes or re-opens the circuit.
+  A failure is an exception of one of failure_exceptions, or a response
+  with one of failure_statuses. 500 isn't among the default statuses,
+  as OnCore answers with it for SOAP faults (e.g. a rejected
+  registration) while otherwise healthy.
+  '''
+
+  def __init__(self, failure_threshold=5, failure_rate=None, window=20,
+               reset_timeout=30,
+               failure_statuses=(502, 503, 504),
+               failure_exceptions=(requests.RequestException,),
+               clock=time.time):
+    self.failure_threshold = failure_threshold
+    self.failure_rate = failure_rate
+    self.reset_timeout = reset_timeout
+    self.failure_statuses = frozenset(failure_statuses)
+    self.failure_exceptions = tuple(failure_exceptions)
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._outcomes = deque(maxlen=window)  # True for each failure
+    self._state = CLOSED
+    self._consecutive_failures = 0
+    self._opened_at = None
+    self._probing = False
+
+  @property
+  def state(self):
+    with self._lock:
+      return self._current_state()
+
+  def _current_state(self):
+    if (self._state == OPEN
+        and self._clock() >= self._opened_at + self.reset_timeout):
+      return HALF_OPEN
+    return self._state
+
+  def stats(self):
+    '''Snapshot of the breaker for monitoring.'''
+    with self._lock:
+      failures = sum(self._outcomes)
+      return {'state': self._current_state(),
+              'consecutive-failures': self._consecutive_failures,
+              'window-failure-rate': (failures / len(self._outcomes)
+                                      if self._outcomes else 0.0),
+              'opened-at': self._opened_at}
+
+  def _before(self):
+    with self._lock:
+      state = self._current_state()
+      if state == CLOSED:
+        return
+      if state == HALF_OPEN and not self._probing:
+        self._state = HALF_OPEN
+        self._probing = True
+        return
+      raise CircuitOpenError('OnCore circuit is %s' % state)
+
+  def _record(self, failed):
+    with self._lock:
+      was_probe = self._probing
+      self._probing = False
+      self._outcomes.append(failed)
+      if not failed:
+        self._consecutive_failures = 0
+        if was_probe:
+          self._close()
+        return
+      self._consecutive_failures += 1
+      if was_probe or self._should_open():
+        self._state = OPEN
+        self._opened_at = self._clock()
+
+  def _should_open(self):
+    if self._consecutive_failures >= self.failure_threshold:
+      return True
+    if (self.failure_rate is not None
+        and len(self._outcomes) == self._outcomes.maxlen):
+      rate = sum(self._outcomes) / len(self._outcomes)
+      return rate >= self.failure_rate
+    return False
+
+  def _close(self):
+    self._state = CLOSED
+    self._opened_at = None
+    self._outcomes.clear()
+
+  def _abandon_probe(self):
+    with self._lock:
+      self._probing = False
+
+  def call(self, send, ignored_exceptions=()):
+    '''Returns send()'s response, recording whether it failed; raises
+    CircuitOpenError without calling send while the circuit is open.
+    Exceptions of ignored_exceptions are re-raised without being
+    recorded, even if they're also failure_exceptions (e.g. the caller
+    running out of time).'''
+    self._before()
+    try:
+      response = send()
+    except ignored_exceptions:
+      self._abandon_probe()
+      raise
+    except self.failure_exceptions:
+      self._record(True)
+      raise
+    except BaseException:
+      self._abandon_probe()
+      raise
+    self._record(response.status_code in self.failure_statuses)
+    return response
+
+  def reset(self):
+    '''Forces the circuit closed.'''
+    with self._lock:
+      self._close()
+      self._consecutive_failures = 0
+      self._probing = False
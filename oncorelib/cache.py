@@ -0,0 +1,167 @@
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+
+__all__ = ['TTLCache', 'DiskCache']
+
+#------------------------------------------------------------------------------
+# in-memory cache
+
+class TTLCache(object):
+  '''Bounded, thread-safe in-memory cache with per-entry TTL expiry and
+  LRU eviction. Keeps hit/miss counters for monitoring.
+  Args:
+    o maxsize: max number of entries kept; least recently used entries
+       are evicted beyond that.
+    o ttl: seconds an entry stays valid after it is stored.
+  '''
+
+  def __init__(self, maxsize=128, ttl=300, clock=time.time):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._clock = clock
+    self._data = OrderedDict()  # key -> (expires-at, value)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.pop(key, None)
+      if entry is None or entry[0] <= self._clock():
+        self.misses += 1
+        return default
+      self._data[key] = entry  # re-insert as most recently used
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key, value):
+    with self._lock:
+      self._data.pop(key, None)
+      self._data[key] = (self._clock() + self.ttl, value)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def invalidate(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses,
+            'size': len(self._data), 'maxsize': self.maxsize}
+
+#------------------------------------------------------------------------------
+# on-disk response cache
+
+class DiskCache(object):
+  '''Persistent SQLite-backed cache of raw OnCore responses, so that
+  lookups survive process restarts. Entries are keyed by a hash of the
+  service URL and outgoing envelope.
+  Args:
+    o path: SQLite database file (created if missing)
+    o ttls: map of operation name -> seconds to keep its responses;
+       operations not listed are never cached.
+    o max_entries: cap on stored responses; least recently used ones
+       are evicted beyond that.
+  '''
+
+  def __init__(self, path, ttls=None, max_entries=100000, clock=time.time):
+    if ttls is None:
+      ttls = {'get_protocol': 3600, 'get_subject_data': 3600}
+    self.ttls = ttls
+    self.max_entries = max_entries
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    with self._conn:
+      self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         ' key TEXT PRIMARY KEY,'
+                         ' op TEXT,'
+                         ' expires REAL,'
+                         ' accessed REAL,'
+                         ' status INTEGER,'
+                         ' xml BLOB)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed'
+                         ' ON responses (accessed)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS responses_expires'
+                         ' ON responses (expires)')
+    # Running row count, so puts don't need a COUNT(*) scan.
+    self._count = self._conn.execute('SELECT COUNT(*) FROM responses'
+                                     ).fetchone()[0]
+
+  @staticmethod
+  def _key(url, xml):
+    digest = hashlib.sha256(url.encode('utf_8'))
+    digest.update(xml.encode('utf_8'))
+    return digest.hexdigest()
+
+  def get(self, url, xml, op):
+    '''Returns (status code, response XML) or None.'''
+    if op not in self.ttls:
+      return None
+    key = self._key(url, xml)
+    now = self._clock()
+    with self._lock, self._conn:
+      row = self._conn.execute('SELECT expires, status, xml FROM responses'
+                               ' WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        return None
+      if row[0] <= now:
+        self._delete('key = ?', (key,))
+        return None
+      self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                         (now, key))
+    return row[1], bytes(row[2])
+
+  def put(self, url, xml, op, status_code, response_xml):
+    if op not in self.ttls:
+      return
+    key = self._key(url, xml)
+    now = self._clock()
+    row = (op, now + self.ttls[op], now, status_code,
+           sqlite3.Binary(response_xml), key)
+    with self._lock, self._conn:
+      updated = self._conn.execute('UPDATE responses SET op = ?,'
+                                   ' expires = ?, accessed = ?, status = ?,'
+                                   ' xml = ? WHERE key = ?', row).rowcount
+      if not updated:
+        self._conn.execute('INSERT INTO responses'
+                           ' (op, expires, accessed, status, xml, key)'
+                           ' VALUES (?, ?, ?, ?, ?, ?)', row)
+        self._count += 1
+        if self._count > self.max_entries:
+          self._evict(now)
+
+  def _delete(self, where, params):
+    self._count -= self._conn.execute('DELETE FROM responses WHERE ' + where,
+                                      params).rowcount
+
+  def _evict(self, now):
+    self._delete('expires <= ?', (now,))
+    excess = self._count - self.max_entries
+    if excess > 0:
+      self._delete('key IN (SELECT key FROM responses'
+                   ' ORDER BY accessed LIMIT ?)', (excess,))
+
+  def invalidate_op(self, op):
+    with self._lock, self._conn:
+      self._delete('op = ?', (op,))
+
+  def clear(self):
+    with self._lock, self._conn:
+      self._delete('1', ())
+
+  def close(self):
+    self._conn.close()
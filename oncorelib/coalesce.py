@@ -0,0 +1,71 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from retry import DeadlineExceeded
+
+__all__ = ['SingleFlight']
+
+#------------------------------------------------------------------------------
+# request coalescing
+
+class _Flight(object):
+
+  def __init__(self, deadline):
+    self.done = threading.Event()
+    self.deadline = deadline
+    self.result = None
+    self.error = None
+
+def _later(deadline, than):
+  '''Whether deadline (None for none) leaves more time than than.'''
+  return deadline is None or (than is not None and deadline > than)
+
+class SingleFlight(object):
+  '''Lets concurrent callers asking for the same key share one call:
+  the first caller runs it, the others wait and receive its result (or
+  its exception). Nothing is kept once the call finishes.'''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._flights = {}
+
+  def do(self, key, fn, deadline=None, copy=None):
+    '''Returns fn(), or the result of the call already in flight for
+    key. deadline is the caller's absolute time limit: a waiting caller
+    gives up with DeadlineExceeded when it passes, and if the call
+    failed with DeadlineExceeded only because its own caller had less
+    time, runs fn itself rather than sharing that error. copy, if
+    given, is applied to the result for every caller, leader included,
+    so none of them sees another's changes.'''
+    with self._lock:
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight(deadline)
+    if not leader:
+      return self._follow(flight, fn, deadline, copy)
+    try:
+      flight.result = fn()
+    except BaseException as e:
+      flight.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.done.set()
+    return flight.result if copy is None else copy(flight.result)
+
+  def _follow(self, flight, fn, deadline, copy):
+    if deadline is None:
+      flight.done.wait()
+    elif not flight.done.wait(max(0, deadline - time.time())):
+      raise DeadlineExceeded('deadline exceeded waiting on a coalesced call')
+    if flight.error is not None:
+      if (isinstance(flight.error, DeadlineExceeded)
+          and _later(deadline, flight.deadline)):
+        return fn()
+      raise flight.error
+    return flight.result if copy is None else copy(flight.result)
@@ -1,70 +1,693 @@
 from __future__ import division
 from __future__ import print_function
 
-from string import Template
+from collections import MutableMapping, namedtuple
+import json
+import re
+import threading
+import time
+from xml.parsers import expat
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests_toolbelt.multipart import decoder
 import xmltodict
 
+from coalesce import SingleFlight
+from retry import DeadlineExceeded, IDEMPOTENT_OPS
+from transport import RecordingTransport, ReplayResponse
+
+__all__ = ['ResponseError', 'Client', 'decode_response', 'LazyResult',
+           'get_client', 'enable_protocol_cache', 'enable_response_cache',
+           'enable_retries', 'enable_rate_limit', 'enable_circuit_breaker',
+           'add_instrumentation_hook', 'set_transport', 'record_transport',
+           'close_clients', 'get_protocol', 'get_subject_data',
+           'subject_record_exists', 'extract_primary_identifier',
+           'extract_subject_num', 'extract_first_name', 'extract_last_name',
+           'extract_birthdate', 'extract_gender', 'extract_races',
+           'extract_ethnicity', 'scan_subject_xml', 'prep_subject_xml',
+           'Subject', 'to_subject', 'Site', 'Staff', 'Protocol',
+           'scan_protocol_xml', 'parse_protocol', 'verify_reg_data',
+           'prep_subject_data', 'register_subject_to_protocol']
+
 #------------------------------------------------------------------------------
 
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+STREAM_CHUNK_SIZE = 16 * 1024
+# Smaller reads when a deadline applies, as each one blocks until it's
+# filled; the time is checked between them.
+DEADLINE_CHUNK_SIZE = 1024
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+
+class ResponseError(KeyError):
+  '''Raised when a response doesn't hold the expected record: a non-200
+  status (e.g. a SOAP fault) or a body without the record element. A
+  KeyError, as the extract_* functions raise for missing elements.
+  status_code is the response's HTTP status code.'''
+
+  def __init__(self, message, status_code=None):
+    KeyError.__init__(self, message)
+    self.status_code = status_code
+
+  def __str__(self):
+    return self.args[0]
+
+class Client(object):
+  '''Holds a pooled, reusable requests.Session for a single spec so that
+  successive calls to the same OnCore endpoint reuse open connections
+  instead of paying a fresh TCP+TLS handshake each time.
+  Pool settings are taken from the keyword args if given, otherwise from
+  the optional spec keys (see README), otherwise from the defaults.
+  If protocol_cache is given (e.g. a cache.TTLCache), get_protocol results
+  are cached in it, keyed by (service-url, protocol number). The cached
+  map is shared between callers so it shouldn't be mutated.
+  If response_cache is given (e.g. a cache.DiskCache), raw responses to
+  read operations are cached in it; registrations always bypass it.
+  If stream is True (or the spec's 'stream' key is), response bodies are
+  fed to the XML parser incrementally as they arrive instead of being
+  buffered first; with keep_xml False the raw XML isn't retained either
+  and the result's 'xml' is None, which keeps peak memory to the parsed
+  data plus one chunk.
+  If retry_policy is given (see retry.RetryPolicy), failed calls are
+  retried according to it.
+  If rate_limiter is given (see ratelimit.RateLimiter), every request,
+  including each retry, waits on it first.
+  If circuit_breaker is given (see breaker.CircuitBreaker), requests fail
+  fast with breaker.CircuitOpenError while it is open.
+  connect_timeout and read_timeout (seconds; spec keys 'connect-timeout'
+  and 'read-timeout') bound each request; None means wait indefinitely.
+  hooks is a list of instrumentation callables (e.g. a
+  metrics.HistogramCollector); each is called with an event map per
+  phase of every call, with keys 'op', 'phase' and 'seconds'. Phases:
+    o 'request': from sending the request until the response headers
+       arrive (connect time and server time; requests doesn't expose
+       them separately), once per attempt; a failed attempt's event
+       runs until it failed and has 'error', the exception's type name
+    o 'transfer': reading the rest of the body, once per attempt
+       (buffered mode only)
+    o 'decode': locating the SOAP root part (buffered mode)
+    o 'stream-parse': receiving and parsing the body (stream mode)
+    o 'parse': xmltodict.parse, when structured-data is first accessed
+    o 'total': the whole call, failed or not; this event also has
+       'status-code', 'request-bytes', 'response-bytes', 'cached' and
+       'error' (None, or the type name of the exception the call raised,
+       in which case 'status-code' and 'response-bytes' are None)
+  transport, if given, replaces the session for sending requests; it
+  needs a post method taking the same arguments as requests.Session.post
+  and returning something response-like (see transport for recording
+  and replaying transports).
+  If coalesce is True (or the spec's 'coalesce' key is), concurrent
+  identical get_protocol/get_subject_data calls share one in-flight
+  request (see coalesce.SingleFlight). Each caller gets its own copy of
+  the result map, but any structured data already parsed is shared and
+  mustn't be mutated.
+  '''
+
+  def __init__(self, spec, pool_connections=None, pool_maxsize=None,
+               pool_block=None, keep_alive=None, protocol_cache=None,
+               response_cache=None, stream=None, keep_xml=True,
+               retry_policy=None, rate_limiter=None, circuit_breaker=None,
+               connect_timeout=None, read_timeout=None, hooks=None,
+               transport=None, coalesce=None):
+    self.spec = spec
+    self.single_flight = (SingleFlight()
+                          if _setting(coalesce, spec, 'coalesce', False)
+                          else None)
+    self.hooks = list(hooks or [])
+    self.connect_timeout = _setting(connect_timeout, spec, 'connect-timeout',
+                                    DEFAULT_CONNECT_TIMEOUT)
+    self.read_timeout = _setting(read_timeout, spec, 'read-timeout',
+                                 DEFAULT_READ_TIMEOUT)
+    self.circuit_breaker = circuit_breaker
+    self.retry_policy = retry_policy
+    self.rate_limiter = rate_limiter
+    self.protocol_cache = protocol_cache
+    self.response_cache = response_cache
+    self.auth = HTTPBasicAuth(spec['user'], spec['password'])
+    self.pool_connections = _setting(pool_connections, spec,
+                                     'pool-connections',
+                                     DEFAULT_POOL_CONNECTIONS)
+    self.pool_maxsize = _setting(pool_maxsize, spec, 'pool-maxsize',
+                                 DEFAULT_POOL_MAXSIZE)
+    self.pool_block = _setting(pool_block, spec, 'pool-block', False)
+    self.keep_alive = _setting(keep_alive, spec, 'keep-alive', True)
+    self.stream = _setting(stream, spec, 'stream', False)
+    self.keep_xml = keep_xml
+    self.session = self._make_session()
+    self.transport = transport if transport is not None else self.session
+
+  def _make_session(self):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                          pool_maxsize=self.pool_maxsize,
+                          pool_block=self.pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not self.keep_alive:
+      session.headers['Connection'] = 'close'
+    return session
+
+  def close(self):
+    self.session.close()
+
+  def call(self, xml, op=None, bypass_cache=False, deadline=None):
+    '''Makes the actual HTTP call to the OnCore SOAP endpoint.
+    Args:
+      o xml: the outgoing XML blob as a unicode string
+      o op: name of the operation (e.g. 'get_subject_data'); used to pick
+         the response cache TTL
+      o bypass_cache: if True the response cache is neither read nor
+         written (always the case for registrations)
+      o deadline: seconds the whole call, retries included, may take;
+         DeadlineExceeded is raised if it runs out
+    Returns a map (a LazyResult) with three keys:
+      o 'status-code': the response's HTTP status code
+      o 'xml': the response's XML blob as a string
+      o 'structured-data': data from the XML reformatted as a
+         nested OrderedDict. Except in stream mode this is only parsed
+         on first access (see LazyResult).
+    '''
+    if type(xml) != unicode:
+      raise TypeError
+    if deadline is not None:
+      deadline += time.time()
+    if self.single_flight is not None and op in IDEMPOTENT_OPS:
+      return self.single_flight.do(
+        (op, xml), lambda: self._call(xml, op, bypass_cache, deadline),
+        deadline, LazyResult.copy)
+    return self._call(xml, op, bypass_cache, deadline)
+
+  def _call(self, xml, op, bypass_cache, deadline):
+    '''call, with deadline as an absolute time.'''
+    started = time.time()
+    try:
+      return self._fetch(xml, op, bypass_cache, deadline, started)
+    except Exception as e:
+      self._emit_total(op, started, None, xml, None, False, error=e)
+      raise
+
+  def _fetch(self, xml, op, bypass_cache, deadline, started):
+    '''_call, less the 'total' event for a call that raises.'''
+    url = self.spec['service-url']
+    on_parse = self._phase_hook(op, 'parse') if self.hooks else None
+    cache = None if bypass_cache else self.response_cache
+    if cache is not None:
+      hit = cache.get(url, xml, op)
+      if hit is not None:
+        status_code, response_xml = hit
+        self._emit_total(op, started, status_code, xml, response_xml, True)
+        return LazyResult(status_code, response_xml, on_parse)
+    result = self._send(xml, op, deadline)
+    phase_started = time.time()
+    if self.stream:
+      status_code, response_xml, structured_data = _read_streaming(
+        result, self.keep_xml, deadline)
+      self._emit(op, 'stream-parse', time.time() - phase_started)
+    else:
+      status_code = result.status_code
+      response_xml = _root_part(result.headers.get('content-type', ''),
+                                result.content)
+      self._emit(op, 'decode', time.time() - phase_started)
+    if cache is not None and status_code == 200 and response_xml is not None:
+      cache.put(url, xml, op, status_code, response_xml)
+    self._emit_total(op, started, status_code, xml, response_xml, False,
+                     result)
+    response = LazyResult(status_code, response_xml, on_parse)
+    if self.stream:
+      response['structured-data'] = structured_data
+    return response
+
+  def call_raw(self, xml, op=None, deadline=None):
+    '''Sends xml like call does (retries, limits and timeouts included)
+    but skips caching, decoding and parsing. Returns (status code,
+    content type, body bytes); decode_response turns that into the
+    response XML, e.g. in another process.'''
+    started = time.time()
+    if deadline is not None:
+      deadline = started + deadline
+    try:
+      result = self._send(xml, op, deadline)
+      raw = (result.status_code, result.headers.get('content-type', ''),
+             _read_body(result, deadline))
+    except Exception as e:
+      self._emit_total(op, started, None, xml, None, False, error=e)
+      raise
+    self._emit_total(op, started, raw[0], xml, raw[2], False)
+    return raw
+
+  def _emit(self, op, phase, seconds, extra=None):
+    if not self.hooks:
+      return
+    event = {'op': op, 'phase': phase, 'seconds': seconds}
+    if extra:
+      event.update(extra)
+    for hook in self.hooks:
+      hook(event)
+
+  def _phase_hook(self, op, phase):
+    return lambda seconds: self._emit(op, phase, seconds)
+
+  def _emit_total(self, op, started, status_code, xml, response_xml,
+                  cached, result=None, error=None):
+    if not self.hooks:
+      return
+    if result is not None and result.headers.get('content-length'):
+      response_bytes = int(result.headers['content-length'])
+    else:
+      response_bytes = len(response_xml) if response_xml is not None else None
+    self._emit(op, 'total', time.time() - started,
+               {'status-code': status_code,
+                'request-bytes': len(xml.encode('utf_8')),
+                'response-bytes': response_bytes,
+                'cached': cached,
+                'error': None if error is None else type(error).__name__})
+
+  def _send(self, xml, op, deadline=None):
+    '''POSTs the outgoing xml, retrying per retry_policy if it applies
+    to op. Each attempt goes through the circuit breaker and rate limiter
+    when those are set, and its read timeout is cut down to whatever
+    remains before deadline (an absolute time). Running out of time, be
+    it a timeout cut down that way, a body still arriving or a rate
+    limiter wait, surfaces as DeadlineExceeded. Returns the requests
+    Response (or, in buffered mode with a deadline, a response-like
+    transport.ReplayResponse).'''
+    headers = {'content-type': 'text/xml'}
+    data = xml.encode('utf_8')
+    # With a deadline, buffered bodies are read here in chunks, checking
+    # the time between them; socket timeouts alone don't bound a body
+    # that keeps trickling in.
+    chunked = deadline is not None and not self.stream
+    def post():
+      timeout, capped = self._timeout(deadline)
+      sent = time.time()
+      try:
+        response = self.transport.post(self.spec['service-url'], data=data,
+                                       headers=headers, auth=self.auth,
+                                       stream=self.stream or chunked,
+                                       timeout=timeout)
+        waited = response.elapsed.total_seconds()
+        if chunked:
+          response = ReplayResponse(response.status_code, response.headers,
+                                    _read_body(response, deadline), waited)
+      except Exception as e:
+        if self.hooks:
+          self._emit(op, 'request', time.time() - sent,
+                     {'error': type(e).__name__})
+        # Read timeouts in the body surface as ConnectionError.
+        if (isinstance(e, (requests.Timeout, requests.ConnectionError))
+            and capped and time.time() >= deadline
+            and not isinstance(e, DeadlineExceeded)):
+          raise DeadlineExceeded('OnCore call deadline exceeded (%s)' % e)
+        raise
+      if self.hooks:
+        self._emit(op, 'request', waited)
+        if not self.stream:
+          self._emit(op, 'transfer', max(0, time.time() - sent - waited))
+      return response
+    def attempt():
+      if self.rate_limiter is None:
+        return post()
+      if not self.rate_limiter.acquire(deadline):
+        raise DeadlineExceeded('OnCore call deadline exceeded waiting on'
+                               ' the rate limiter')
+      try:
+        return post()
+      finally:
+        self.rate_limiter.release()
+    def guarded():
+      # Running out of time is down to the caller, not OnCore, so it's
+      # checked before the breaker and never recorded by it.
+      self._timeout(deadline)
+      if self.circuit_breaker is None:
+        return attempt()
+      return self.circuit_breaker.call(attempt, (DeadlineExceeded,))
+    policy = self.retry_policy
+    if policy is None or not policy.applies_to(op):
+      return guarded()
+    return policy.run(guarded, deadline)
+
+  def _timeout(self, deadline):
+    '''Returns ((connect, read) timeouts for one request, capped by
+    deadline; whether either was cut down by the cap).'''
+    timeouts = (self.connect_timeout, self.read_timeout)
+    if deadline is None:
+      return timeouts, False
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      raise DeadlineExceeded('OnCore call deadline exceeded')
+    capped = tuple(remaining if t is None else min(t, remaining)
+                   for t in timeouts)
+    return capped, capped != timeouts
+
+  def get_protocol(self, protocol_num, deadline=None):
+    if self.protocol_cache is None:
+      return self.call(_protocol_xml(protocol_num), 'get_protocol',
+                       deadline=deadline)
+    key = (self.spec['service-url'], protocol_num)
+    result = self.protocol_cache.get(key)
+    if result is None:
+      result = self.call(_protocol_xml(protocol_num), 'get_protocol',
+                         deadline=deadline)
+      if result['status-code'] == 200:
+        self.protocol_cache.put(key, result)
+    return result
+
+  def get_subject_data(self, primary_id, deadline=None):
+    return self.call(_subject_data_xml(primary_id), 'get_subject_data',
+                     deadline=deadline)
+
+  def register_subject_to_protocol(self, reg_data, subject_num=None,
+                                   deadline=None):
+    '''See the module-level register_subject_to_protocol.'''
+    return self.call(_registration_xml(reg_data, subject_num),
+                     'register_subject_to_protocol', bypass_cache=True,
+                     deadline=deadline)
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+def _root_part(content_type, body):
+  '''Returns the SOAP root part of a response body. Plain XML bodies are
+  used as-is; for multipart (MTOM) bodies only the first part is sliced
+  out, without decoding any attachments that follow it.'''
+  if not content_type.lower().startswith('multipart/'):
+    return body
+  match = _BOUNDARY_RE.search(content_type)
+  if match:
+    delimiter = b'--' + match.group(1).encode('ascii')
+    start = body.find(delimiter)
+    headers_end = body.find(b'\r\n\r\n', start)
+    end = body.find(b'\r\n' + delimiter, headers_end)
+    if -1 not in (start, headers_end, end):
+      return body[headers_end + 4:end]
+  # Unusual framing; let the full decoder deal with it.
+  return decoder.MultipartDecoder(body, content_type).parts[0].content
+
+def decode_response(status_code, content_type, body):
+  '''Turns the output of Client.call_raw into the same map _call
+  returns.'''
+  return LazyResult(status_code, _root_part(content_type, body))
+
+def _iter_body(result, deadline):
+  '''Iterates over a stream=True response's body, raising
+  DeadlineExceeded once deadline (an absolute time, or None for no
+  limit) has passed.'''
+  if deadline is None:
+    for chunk in result.iter_content(STREAM_CHUNK_SIZE):
+      yield chunk
+    return
+  for chunk in result.iter_content(DEADLINE_CHUNK_SIZE):
+    if time.time() > deadline:
+      raise DeadlineExceeded('OnCore call deadline exceeded while reading'
+                             ' the response')
+    yield chunk
+
+def _read_body(result, deadline):
+  '''Reads a response's body in full, within deadline if it was sent
+  with stream=True.'''
+  try:
+    if deadline is None:
+      return result.content
+    return b''.join(_iter_body(result, deadline))
+  finally:
+    result.close()
+
+def _read_streaming(result, keep_xml, deadline=None):
+  '''Parses the root part of a stream=True response while it is being
+  received, within deadline. Returns (status code, response XML or None,
+  structured data).
+  '''
+  try:
+    chunks = _iter_body(result, deadline)
+    reader = _ChunkReader(_iter_root_part(result, chunks), keep_xml)
+    structured_data = xmltodict.parse(reader)
+    for _ in chunks:
+      pass  # drain any attachments so the connection can be reused
+  finally:
+    result.close()
+  return result.status_code, reader.data(), structured_data
+
+def _iter_root_part(result, chunks):
+  '''Streaming counterpart of _root_part: yields the root part of the
+  body in pieces as they're read from chunks, and stops consuming chunks
+  once the root part's closing boundary is seen.'''
+  content_type = result.headers.get('content-type', '')
+  if not content_type.lower().startswith('multipart/'):
+    for chunk in chunks:
+      yield chunk
+    return
+  match = _BOUNDARY_RE.search(content_type)
+  if not match:
+    yield _root_part(content_type, b''.join(chunks))
+    return
+  delimiter = b'--' + match.group(1).encode('ascii')
+  buf = b''
+  for chunk in chunks:
+    buf += chunk
+    start = buf.find(delimiter)
+    headers_end = buf.find(b'\r\n\r\n', start) if start != -1 else -1
+    if headers_end != -1:
+      buf = buf[headers_end + 4:]
+      break
+  else:
+    return
+  terminator = b'\r\n' + delimiter
+  hold = len(terminator) - 1  # a terminator may straddle two chunks
+  while True:
+    end = buf.find(terminator)
+    if end != -1:
+      yield buf[:end]
+      return
+    if len(buf) > hold:
+      yield buf[:-hold]
+      buf = buf[-hold:]
+    chunk = next(chunks, None)
+    if chunk is None:
+      yield buf
+      return
+    buf += chunk
+
+class _ChunkReader(object):
+  '''Minimal file-like wrapper over an iterator of byte strings, for
+  feeding expat (via xmltodict.parse) incrementally.'''
+
+  def __init__(self, pieces, keep):
+    self._pieces = pieces
+    self._rest = b''  # what's left of the current piece
+    self._kept = [] if keep else None
+
+  def read(self, size=-1):
+    # expat only needs non-empty reads until the end, so at most one
+    # piece per read is fine, but it rejects more than size bytes.
+    if not self._rest:
+      for piece in self._pieces:
+        if piece:
+          if self._kept is not None:
+            self._kept.append(piece)
+          self._rest = piece
+          break
+    if size < 0:
+      size = len(self._rest)
+    data, self._rest = self._rest[:size], self._rest[size:]
+    return data
+
+  def data(self):
+    return None if self._kept is None else b''.join(self._kept)
+
+class LazyResult(MutableMapping):
+  '''The map returned by _call, with the same three keys as a plain
+  dict, except that 'structured-data' is parsed from 'xml' only when
+  first looked up and then memoised. Callers that only need the status
+  code or raw XML never pay for the parse. Anything reading every value
+  (items, dict(result), update, **result, comparison, repr) parses
+  first. Not a dict subclass, since dict's own fast paths would skip
+  the unparsed key; where a real dict is needed (json.dumps,
+  isinstance checks) pass dict(result). on_parse, if given, is called
+  with the seconds the parse took.'''
+
+  def __init__(self, status_code, response_xml, on_parse=None):
+    self._data = {'status-code': status_code, 'xml': response_xml}
+    self._pending = True  # 'structured-data' not yet parsed or replaced
+    self._on_parse = on_parse
+
+  def _unparsed(self):
+    return self._pending and 'structured-data' not in self._data
+
+  def _parse(self):
+    if self._unparsed():
+      started = time.time()
+      self._data['structured-data'] = xmltodict.parse(self._data['xml'])
+      if self._on_parse is not None:
+        self._on_parse(time.time() - started)
+    self._pending = False
+
+  def __getitem__(self, key):
+    if key == 'structured-data':
+      self._parse()
+    return self._data[key]
+
+  def __setitem__(self, key, value):
+    if key == 'structured-data':
+      self._pending = False
+    self._data[key] = value
+
+  def __delitem__(self, key):
+    if key == 'structured-data' and self._unparsed():
+      self._pending = False
+      return
+    del self._data[key]
+
+  def __contains__(self, key):
+    return (key in self._data
+            or (key == 'structured-data' and self._unparsed()))
+
+  has_key = __contains__
+
+  def __iter__(self):
+    unparsed = self._unparsed()
+    for key in list(self._data):
+      yield key
+    if unparsed:
+      yield 'structured-data'
+
+  def __len__(self):
+    return len(self._data) + (1 if self._unparsed() else 0)
+
+  def copy(self):
+    '''Shallow copy that doesn't trigger the parse; an unparsed copy
+    parses on its own when looked up.'''
+    other = LazyResult(None, None, self._on_parse)
+    other._data = dict(self._data)
+    other._pending = self._pending
+    return other
+
+  def __repr__(self):
+    return repr(dict(self))
+
+def _setting(value, spec, key, default):
+  '''Explicit value, else optional spec key, else default.'''
+  if value is not None: return value
+  return spec.get(key, default)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _spec_key(spec):
+  # Whole spec, so specs differing only in options (stream, timeouts,
+  # pool sizes...) get their own clients.
+  return json.dumps(spec, sort_keys=True)
+
+def get_client(spec):
+  '''Returns the default Client for spec, creating it on first use.
+  All module-level functions taking an equal spec go through this
+  client, so they share one connection pool.'''
+  key = _spec_key(spec)
+  with _clients_lock:
+    client = _clients.get(key)
+    if client is None:
+      client = _clients[key] = Client(spec)
+    return client
+
+def enable_protocol_cache(spec, cache):
+  '''Opts the default client for spec into caching get_protocol
+  results in cache (e.g. a cache.TTLCache); pass None to turn it off.'''
+  get_client(spec).protocol_cache = cache
+
+def enable_response_cache(spec, cache):
+  '''Opts the default client for spec into caching raw responses in
+  cache (e.g. a cache.DiskCache); pass None to turn it off.'''
+  get_client(spec).response_cache = cache
+
+def enable_retries(spec, policy):
+  '''Opts the default client for spec into retrying failed calls per
+  policy (a retry.RetryPolicy); pass None to turn it off.'''
+  get_client(spec).retry_policy = policy
+
+def enable_rate_limit(spec, limiter):
+  '''Makes the default client for spec go through limiter (a
+  ratelimit.RateLimiter); pass None to turn it off.'''
+  get_client(spec).rate_limiter = limiter
+
+def enable_circuit_breaker(spec, breaker):
+  '''Puts the default client for spec behind breaker (a
+  breaker.CircuitBreaker); pass None to turn it off.'''
+  get_client(spec).circuit_breaker = breaker
+
+def add_instrumentation_hook(spec, hook):
+  '''Adds hook (see Client) to the default client for spec.'''
+  get_client(spec).hooks.append(hook)
+
+def set_transport(spec, transport):
+  '''Makes the default client for spec send through transport (see
+  Client); pass None to go back to its pooled session.'''
+  client = get_client(spec)
+  client.transport = transport if transport is not None else client.session
+
+def record_transport(spec, path):
+  '''Makes the default client for spec record its traffic to path via a
+  transport.RecordingTransport over its own pooled session, and returns
+  that transport (close it when done, then set_transport(spec, None)).
+  '''
+  client = get_client(spec)
+  recorder = RecordingTransport(path, client.session)
+  client.transport = recorder
+  return recorder
+
+def close_clients():
+  '''Closes and forgets all default clients created by get_client.'''
+  with _clients_lock:
+    for client in _clients.values():
+      client.close()
+    _clients.clear()
+
 def _call(spec, xml):
-  '''Makes the actual HTTP call to the OnCore SOAP endpoint.
+  '''Makes the actual HTTP call to the OnCore SOAP endpoint using the
+  default client for spec. See Client.call.
   Args:
     o spec: see README
     o xml: the outgoing XML blob as a unicode string
-  Returns a map with three keys:
-    o 'status-code': the response's HTTP status code
-    o 'xml': the response's XML blob as a string
-    o 'structured-data': data from the XML reformatted as a
-       nested OrderedDict.
   '''
-  if type(xml) != unicode:
-    raise TypeError
-  headers = {'content-type': 'text/xml'}
-  auth = HTTPBasicAuth(spec['user'], spec['password'])
-  result = requests.post(spec['service-url'], data=xml.encode('utf_8'),
-                         headers=headers, auth=auth)
-  multipart_data = decoder.MultipartDecoder.from_response(result) 
-  response_xml = multipart_data.parts[0].content
-  structured_data = xmltodict.parse(response_xml)
-  return {'status-code': result.status_code,
-          'xml': response_xml,
-          'structured-data': structured_data}
+  return get_client(spec).call(xml)
 
 #------------------------------------------------------------------------------
 
-def get_protocol(spec, protocol_num):
-  xml = (u'''
-<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
-                  xmlns:data="http://data.service.opas.percipenz.com">
-   <soapenv:Header/>
-   <soapenv:Body>
-      <data:ProtocolSearchCriteria>
-         <!--type: string-->
-         <protocolNo>{PROTOCOL_NUM}</protocolNo>
-      </data:ProtocolSearchCriteria>
-   </soapenv:Body>
-</soapenv:Envelope>
-  ''').format(PROTOCOL_NUM=protocol_num)
-  return _call(spec, xml)
-
-def get_subject_data(spec, primary_id):
-  xml = (u'''
-<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
-                  xmlns:ser="http://service.opas.percipenz.com">
-   <soapenv:Header/>
-   <soapenv:Body>
-      <ser:SubjectSearchData>
-         <!--type: string-->
-         <PrimaryIdentifier>{PRIMARY_ID}</PrimaryIdentifier>
-      </ser:SubjectSearchData>
-   </soapenv:Body>
-</soapenv:Envelope>
-  ''').format(PRIMARY_ID=primary_id)
-  return _call(spec, xml)
+# Envelopes are built by joining precompiled static fragments with the
+# per-call values, rather than re-running a template over the whole
+# (whitespace-padded) document on every call.
+
+_PROTOCOL_XML = (
+  u'<soapenv:Envelope'
+  u' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+  u' xmlns:data="http://data.service.opas.percipenz.com">'
+  u'<soapenv:Header/><soapenv:Body><data:ProtocolSearchCriteria>'
+  u'<protocolNo>',
+  u'</protocolNo>'
+  u'</data:ProtocolSearchCriteria></soapenv:Body></soapenv:Envelope>')
+
+_SUBJECT_DATA_XML = (
+  u'<soapenv:Envelope'
+  u' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+  u' xmlns:ser="http://service.opas.percipenz.com">'
+  u'<soapenv:Header/><soapenv:Body><ser:SubjectSearchData>'
+  u'<PrimaryIdentifier>',
+  u'</PrimaryIdentifier>'
+  u'</ser:SubjectSearchData></soapenv:Body></soapenv:Envelope>')
+
+def _protocol_xml(protocol_num):
+  head, tail = _PROTOCOL_XML
+  return head + unicode(protocol_num) + tail
+
+def _subject_data_xml(primary_id):
+  head, tail = _SUBJECT_DATA_XML
+  return head + unicode(primary_id) + tail
+
+def get_protocol(spec, protocol_num, deadline=None):
+  return get_client(spec).get_protocol(protocol_num, deadline)
+
+def get_subject_data(spec, primary_id, deadline=None):
+  return get_client(spec).get_subject_data(primary_id, deadline)
 
 #------------------------------------------------------------------------------
 # subject data convenience functions
@@ -113,6 +736,241 @@ def extract_races(subject_data):
 def extract_ethnicity(subject_data):
   return _extract_subj_data_elem(subject_data, 'Ethnicity')
 
+def _check_status(data):
+  status_code = data['status-code']
+  if status_code != 200:
+    raise ResponseError('OnCore returned HTTP %s' % status_code, status_code)
+
+_SUBJECT_PATH = ('soap:Envelope', 'soap:Body', 'ns7:Subject')
+
+def scan_subject_xml(response_xml):
+  '''Single pass over a SubjectSearchData response's XML that collects
+  the ns7:Subject element's attributes (keyed '@name') and the text of
+  its direct children, without building the generic xmltodict tree.
+  Values follow xmltodict's conventions: stripped text, None for empty
+  elements, and a list when a child repeats (e.g., Race). Raises
+  ResponseError if there's no ns7:Subject element (e.g. a SOAP fault).
+  '''
+  found = []
+  fields = {}
+  path = []
+  text = []
+  parser = expat.ParserCreate()
+  parser.buffer_text = True
+  def start(name, attrs):
+    path.append(name)
+    if tuple(path) == _SUBJECT_PATH:
+      found.append(True)
+      for k, v in attrs.items():
+        fields['@' + k] = v
+    elif len(path) == 4 and tuple(path[:3]) == _SUBJECT_PATH:
+      del text[:]
+  def end(name):
+    if len(path) == 4 and tuple(path[:3]) == _SUBJECT_PATH:
+      value = u''.join(text).strip() or None
+      if name not in fields:
+        fields[name] = value
+      elif type(fields[name]) == list:
+        fields[name].append(value)
+      else:
+        fields[name] = [fields[name], value]
+    path.pop()
+  def characters(data):
+    if len(path) == 4:
+      text.append(data)
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  parser.CharacterDataHandler = characters
+  parser.Parse(response_xml, True)
+  if not found:
+    raise ResponseError('no ns7:Subject in OnCore response')
+  return fields
+
+def prep_subject_xml(response_xml):
+  '''Fast path for prep_subject_data working directly from the response
+  XML of get_subject_data. Raises KeyError for missing fields, as
+  prep_subject_data does.'''
+  fields = scan_subject_xml(response_xml)
+  races = fields['Race']
+  return {'primary-identifier': fields['PrimaryIdentifier'],
+          'last-name': fields['LastName'],
+          'first-name': fields['FirstName'],
+          'birthdate': fields['BirthDate'],
+          'gender': fields['Gender'],
+          'races': [races] if type(races) == unicode else races,
+          'ethnicity': fields['Ethnicity']}
+
+class Subject(namedtuple('Subject', ['primary_identifier', 'subject_num',
+                                     'last_name', 'first_name', 'birthdate',
+                                     'gender', 'races', 'ethnicity',
+                                     'exists'])):
+  '''Compact, immutable record of one get_subject_data result; a much
+  smaller thing to hold on to than the response map. races is a tuple.
+  Fields missing from the response are None.'''
+  __slots__ = ()
+
+  def prepped(self):
+    '''Returns the same map prep_subject_data would.'''
+    return {'primary-identifier': self.primary_identifier,
+            'last-name': self.last_name,
+            'first-name': self.first_name,
+            'birthdate': self.birthdate,
+            'gender': self.gender,
+            'races': list(self.races),
+            'ethnicity': self.ethnicity}
+
+def to_subject(subject_data, drop_raw=False):
+  '''Converts the result of get_subject_data to a Subject. If drop_raw
+  is True, the 'xml' and 'structured-data' entries are removed from
+  subject_data afterwards so they can be garbage collected. Raises
+  ResponseError if the status code isn't 200 or there's no subject
+  element in the response.'''
+  _check_status(subject_data)
+  if isinstance(subject_data, LazyResult) and subject_data._unparsed():
+    fields = scan_subject_xml(subject_data['xml'])
+  else:
+    body = subject_data['structured-data']['soap:Envelope']['soap:Body']
+    if not body or 'ns7:Subject' not in body:
+      raise ResponseError('no ns7:Subject in OnCore response')
+    fields = body['ns7:Subject'] or {}
+  races = fields.get('Race') or ()
+  subject = Subject(primary_identifier=fields.get('PrimaryIdentifier'),
+                    subject_num=fields.get('SubjectNo'),
+                    last_name=fields.get('LastName'),
+                    first_name=fields.get('FirstName'),
+                    birthdate=fields.get('BirthDate'),
+                    gender=fields.get('Gender'),
+                    races=(races,) if type(races) == unicode else tuple(races),
+                    ethnicity=fields.get('Ethnicity'),
+                    exists=fields.get('@xsi:nil') != u'true')
+  if drop_raw:
+    for key in ('structured-data', 'xml'):
+      if key in subject_data:
+        del subject_data[key]
+  return subject
+
+#------------------------------------------------------------------------------
+# protocol data convenience functions
+#
+# Elements are matched by local name (namespace prefix ignored): the
+# first element in soap:Body is the protocol; its ProtocolNo, Title and
+# Status children are read, plus each StudySite (Name, Status) and
+# ProtocolStaff (LastName, FirstName, Role). A response whose protocol
+# element is missing or has no ProtocolNo (e.g. a SOAP fault) raises
+# ResponseError.
+
+Site = namedtuple('Site', ['name', 'status'])
+
+Staff = namedtuple('Staff', ['last_name', 'first_name', 'role'])
+
+class Protocol(namedtuple('Protocol', ['protocol_num', 'title', 'status',
+                                       'sites', 'staff'])):
+  '''Compact, immutable record of a get_protocol result. sites and
+  staff are tuples of Site and Staff. None if absent.'''
+  __slots__ = ()
+
+_SITE_FIELDS = {'Name': 'name', 'Status': 'status'}
+_STAFF_FIELDS = {'LastName': 'last_name', 'FirstName': 'first_name',
+                 'Role': 'role'}
+_PROTOCOL_FIELDS = {'ProtocolNo': 'protocol_num', 'Title': 'title',
+                    'Status': 'status'}
+
+def _local(name):
+  return name.rsplit(':', 1)[-1]
+
+_NO_PROTOCOL = 'no protocol in OnCore response'
+
+def scan_protocol_xml(response_xml):
+  '''Builds a Protocol from a ProtocolSearchCriteria response's XML in
+  a single expat pass, without building the generic xmltodict tree.'''
+  fields = {'sites': [], 'staff': []}
+  path = []
+  text = []
+  member = {}
+  body_children = []
+  parser = expat.ParserCreate()
+  parser.buffer_text = True
+  def start(name, attrs):
+    path.append(_local(name))
+    del text[:]
+    if len(path) == 3 and path[:2] == ['Envelope', 'Body']:
+      body_children.append(path[2])
+    if len(path) == 4:
+      member.clear()
+  def end(name):
+    depth = len(path)
+    # Only inside the first element in soap:Body (so not soap:Header).
+    relevant = (depth > 3 and path[:2] == ['Envelope', 'Body']
+                and len(body_children) == 1)
+    local = path.pop()
+    value = u''.join(text).strip() or None
+    del text[:]
+    if not relevant:
+      return
+    if depth == 4 and local in _PROTOCOL_FIELDS:
+      fields[_PROTOCOL_FIELDS[local]] = value
+    elif depth == 4 and local == 'StudySite':
+      fields['sites'].append(Site(**dict((f, member.get(f))
+                                         for f in Site._fields)))
+    elif depth == 4 and local == 'ProtocolStaff':
+      fields['staff'].append(Staff(**dict((f, member.get(f))
+                                          for f in Staff._fields)))
+    elif depth == 5 and path[3] == 'StudySite' and local in _SITE_FIELDS:
+      member[_SITE_FIELDS[local]] = value
+    elif depth == 5 and path[3] == 'ProtocolStaff' and local in _STAFF_FIELDS:
+      member[_STAFF_FIELDS[local]] = value
+  def characters(data):
+    text.append(data)
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  parser.CharacterDataHandler = characters
+  parser.Parse(response_xml, True)
+  if (not body_children or body_children[0] == 'Fault'
+      or fields.get('protocol_num') is None):
+    raise ResponseError(_NO_PROTOCOL)
+  return Protocol(protocol_num=fields.get('protocol_num'),
+                  title=fields.get('title'),
+                  status=fields.get('status'),
+                  sites=tuple(fields['sites']),
+                  staff=tuple(fields['staff']))
+
+def _as_list(value):
+  if value is None: return []
+  if type(value) == list: return value
+  return [value]
+
+def _by_local_name(node):
+  return dict((_local(k), v) for k, v in (node or {}).items())
+
+def parse_protocol(protocol_data):
+  '''Takes the result of get_protocol and returns a Protocol. Uses the
+  single-pass scan when the structured-data tree hasn't been built yet,
+  otherwise reads the tree. Raises ResponseError if the status code
+  isn't 200 or there's no protocol in the response.'''
+  _check_status(protocol_data)
+  if isinstance(protocol_data, LazyResult) and protocol_data._unparsed():
+    return scan_protocol_xml(protocol_data['xml'])
+  envelope = _by_local_name(protocol_data['structured-data'])['Envelope']
+  body = _by_local_name(envelope)['Body'] or {}
+  children = [(k, v) for k, v in body.items() if not k.startswith('@')]
+  if not children or _local(children[0][0]) == 'Fault':
+    raise ResponseError(_NO_PROTOCOL)
+  node = _by_local_name(children[0][1])
+  if node.get('ProtocolNo') is None:
+    raise ResponseError(_NO_PROTOCOL)
+  def member(cls, names, element):
+    element = _by_local_name(element)
+    return cls(**dict((field, element.get(name))
+                      for name, field in names.items()))
+  return Protocol(
+    protocol_num=node.get('ProtocolNo'),
+    title=node.get('Title'),
+    status=node.get('Status'),
+    sites=tuple(member(Site, _SITE_FIELDS, e)
+                for e in _as_list(node.get('StudySite'))),
+    staff=tuple(member(Staff, _STAFF_FIELDS, e)
+                for e in _as_list(node.get('ProtocolStaff'))))
+
 #------------------------------------------------------------------------------
 # registration
 
@@ -129,6 +987,9 @@ def prep_subject_data(subject_data):
   '''Returns a map having a standardized format that can be
   used elsewhere when working with demographics (e.g., comparison
   with EHR or REDCap.)'''
+  if isinstance(subject_data, LazyResult) and subject_data._unparsed():
+    # Tree not built yet; scanning the XML once is cheaper.
+    return prep_subject_xml(subject_data['xml'])
   keys = ['primary-identifier',
           'last-name', 'first-name', 'birthdate', 'gender', 'races',
           'ethnicity']
@@ -142,7 +1003,8 @@ def prep_subject_data(subject_data):
               extract_races(subject_data),
               extract_ethnicity(subject_data)]))
 
-def register_subject_to_protocol(spec, reg_data, subject_num=None, xml_only=False):
+def register_subject_to_protocol(spec, reg_data, subject_num=None, xml_only=False,
+                                 deadline=None):
   '''Registers a subject to a protocol. If subject_num
   is included, assumption is this subject already has 
   a record in OnCore and registerExistingSubjectToProtocol
@@ -153,56 +1015,56 @@ def register_subject_to_protocol(spec, reg_data, subject_num=None, xml_only=Fals
   Returns result of _call.
   If xml_only is True, instead of calling API, the prepared XML payload 
   is returned.
+  deadline, if given, is the number of seconds the call may take.
   '''
+  if xml_only: return _registration_xml(reg_data, subject_num)
+  else: return get_client(spec).register_subject_to_protocol(reg_data,
+                                                             subject_num,
+                                                             deadline)
+
+_REGISTRATION_XML = (
+  u'<soapenv:Envelope'
+  u' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+  u' xmlns:sub="http://data.service.opas.percipenz.com/subject">'
+  u'<soapenv:Header/><soapenv:Body><sub:',           # OP_ELEMENT
+  u'><sub:ProtocolSubjectRegistrationData><Context>',  # CONTEXT
+  u'</Context><ProtocolSubject><ProtocolNo>',          # PROTOCOL_NUM
+  u'</ProtocolNo><StudySite>',                         # STUDY_SITE
+  u'</StudySite><Subject><PrimaryIdentifier>',         # PRIMARY_IDENTIFIER
+  u'</PrimaryIdentifier>',                             # SubjectNo, Races
+  u'<LastName>',                                       # LAST_NAME
+  u'</LastName><FirstName>',                           # FIRST_NAME
+  u'</FirstName><BirthDate>',                          # BIRTHDATE
+  u'</BirthDate><Gender>',                             # GENDER
+  u'</Gender><Ethnicity>',                             # ETHNICITY
+  u'</Ethnicity></Subject></ProtocolSubject>'
+  u'</sub:ProtocolSubjectRegistrationData></sub:',     # OP_ELEMENT
+  u'></soapenv:Body></soapenv:Envelope>')
+
+def _registration_xml(reg_data, subject_num=None):
   if not verify_reg_data(reg_data):
     raise ValueError
   op_element = (u'ProtocolExistingSubjectRegistrationData' if subject_num 
                 else u'ProtocolNewSubjectRegistrationData')
-
   subject_num_element = (u'<SubjectNo>' + unicode(subject_num) + u'</SubjectNo>'
-                         if subject_num else '')
-  race_elements = reduce(lambda xml, race: xml + u'<Race>' + race + u'</Race>',
-                         reg_data['races'],
-                         '')
-  xml = Template(u'''
-<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
-                  xmlns:sub="http://data.service.opas.percipenz.com/subject">
-   <soapenv:Header/>
-   <soapenv:Body>
-      <sub:$OP_ELEMENT>
-         <sub:ProtocolSubjectRegistrationData>
-            <Context>$CONTEXT</Context>
-            <ProtocolSubject>
-               <ProtocolNo>$PROTOCOL_NUM</ProtocolNo>
-               <StudySite>$STUDY_SITE</StudySite>
-               <Subject>
-                  <PrimaryIdentifier>$PRIMARY_IDENTIFIER</PrimaryIdentifier>
-                  $SUBJECT_NUM_ELEMENT
-                  $RACE_ELEMENTS
-                  <LastName>$LAST_NAME</LastName>
-                  <FirstName>$FIRST_NAME</FirstName>
-                  <BirthDate>$BIRTHDATE</BirthDate>
-                  <Gender>$GENDER</Gender>
-                  <Ethnicity>$ETHNICITY</Ethnicity>
-               </Subject>
-            </ProtocolSubject>
-         </sub:ProtocolSubjectRegistrationData>
-      </sub:$OP_ELEMENT>
-   </soapenv:Body>
-</soapenv:Envelope>
-      ''')
-  prepped = xml.substitute(OP_ELEMENT=op_element,
-                           CONTEXT=reg_data['context'],
-                           PROTOCOL_NUM=reg_data['protocol-num'],
-                           STUDY_SITE=reg_data['study-site'],
-                           PRIMARY_IDENTIFIER=reg_data['primary-identifier'],
-                           SUBJECT_NUM_ELEMENT=subject_num_element,
-                           RACE_ELEMENTS=race_elements,
-                           LAST_NAME=reg_data['last-name'],
-                           FIRST_NAME=reg_data['first-name'],
-                           BIRTHDATE=reg_data['birthdate'],
-                           GENDER=reg_data['gender'],
-                           ETHNICITY=reg_data['ethnicity'],)
-  if xml_only: return prepped
-  else: return _call(spec, prepped)
-
+                         if subject_num else u'')
+  race_elements = u''.join([u'<Race>' + unicode(race) + u'</Race>'
+                            for race in reg_data['races']])
+  values = (op_element,
+            unicode(reg_data['context']),
+            unicode(reg_data['protocol-num']),
+            unicode(reg_data['study-site']),
+            unicode(reg_data['primary-identifier']),
+            subject_num_element + race_elements,
+            unicode(reg_data['last-name']),
+            unicode(reg_data['first-name']),
+            unicode(reg_data['birthdate']),
+            unicode(reg_data['gender']),
+            unicode(reg_data['ethnicity']),
+            op_element)
+  fragments = _REGISTRATION_XML
+  parts = [fragments[0]]
+  for value, fragment in zip(values, fragments[1:]):
+    parts.append(value)
+    parts.append(fragment)
+  return u''.join(parts)
@@ -0,0 +1,121 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+
+__all__ = ['HistogramCollector']
+
+#------------------------------------------------------------------------------
+# instrumentation
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class _Histogram(object):
+
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, seconds):
+    for i, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.total += seconds
+    self.min = seconds if self.min is None else min(self.min, seconds)
+    self.max = seconds if self.max is None else max(self.max, seconds)
+
+  def quantile(self, q):
+    '''Upper bound of the bucket holding the q-th quantile.'''
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for bound, n in zip(BUCKETS, self.counts):
+      seen += n
+      if seen >= rank:
+        return min(bound, self.max)
+    return self.max
+
+class HistogramCollector(object):
+  '''Built-in instrumentation hook (see Client) that keeps, in memory,
+  a latency histogram per (operation, phase), status code and error
+  type counts per operation, and request/response byte totals. Failed
+  calls count under status code None. Thread-safe; use snapshot() or
+  dump() at the end of a batch.'''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._histograms = {}  # (op, phase) -> _Histogram
+    self._calls = {}       # op -> call totals
+
+  def __call__(self, event):
+    op, phase = event['op'], event['phase']
+    with self._lock:
+      histogram = self._histograms.get((op, phase))
+      if histogram is None:
+        histogram = self._histograms[(op, phase)] = _Histogram()
+      histogram.add(event['seconds'])
+      if phase != 'total':
+        return
+      calls = self._calls.setdefault(op, {'status-codes': {},
+                                          'errors': {},
+                                          'request-bytes': 0,
+                                          'response-bytes': 0,
+                                          'cached': 0})
+      codes = calls['status-codes']
+      codes[event['status-code']] = codes.get(event['status-code'], 0) + 1
+      error = event.get('error')
+      if error is not None:
+        calls['errors'][error] = calls['errors'].get(error, 0) + 1
+      calls['request-bytes'] += event['request-bytes'] or 0
+      calls['response-bytes'] += event['response-bytes'] or 0
+      calls['cached'] += 1 if event['cached'] else 0
+
+  def snapshot(self):
+    '''Returns {'phases': {(op, phase): stats}, 'calls': {op: totals}}.'''
+    with self._lock:
+      phases = {}
+      for key, h in self._histograms.items():
+        phases[key] = {'count': h.count, 'sum': h.total,
+                       'mean': h.total / h.count, 'min': h.min,
+                       'max': h.max, 'p50': h.quantile(0.5),
+                       'p90': h.quantile(0.9), 'p99': h.quantile(0.99),
+                       'buckets': list(zip(BUCKETS, h.counts))}
+      calls = dict((op, dict(totals,
+                             **{'status-codes': dict(totals['status-codes']),
+                                'errors': dict(totals['errors'])}))
+                   for op, totals in self._calls.items())
+    return {'phases': phases, 'calls': calls}
+
+  def dump(self, out=sys.stdout):
+    '''Writes a plain-text summary table to out.'''
+    snap = self.snapshot()
+    print('%-30s %-13s %7s %9s %9s %9s %9s' % (
+      'op', 'phase', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'),
+      file=out)
+    for (op, phase), st in sorted(snap['phases'].items(),
+                                  key=lambda item: (str(item[0][0]),
+                                                    item[0][1])):
+      print('%-30s %-13s %7d %9.1f %9.1f %9.1f %9.1f' % (
+        op, phase, st['count'], st['mean'] * 1000, st['p50'] * 1000,
+        st['p99'] * 1000, st['max'] * 1000), file=out)
+    for op, totals in sorted(snap['calls'].items(),
+                             key=lambda item: str(item[0])):
+      print('%s: status codes %s, errors %s, %d request bytes, '
+            '%d response bytes, %d cached' % (
+              op, totals['status-codes'], totals['errors'],
+              totals['request-bytes'], totals['response-bytes'],
+              totals['cached']), file=out)
+
+  def reset(self):
+    with self._lock:
+      self._histograms.clear()
+      self._calls.clear()
@@ -0,0 +1,144 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sqlite3
+import threading
+import time
+from xml.parsers import expat
+
+from batch import get_subject_data_many, DEFAULT_MAX_WORKERS
+from core import Subject, to_subject
+
+__all__ = ['SubjectMirror']
+
+#------------------------------------------------------------------------------
+# local subject mirror
+
+class SubjectMirror(object):
+  '''Local SQLite copy of OnCore subject records, indexed by primary
+  identifier and SubjectNo, for answering repeated subject_record_exists
+  and prep_subject_data questions without a SOAP round-trip.
+  Populate it with load, keep it current with refresh.
+  '''
+
+  def __init__(self, path, clock=time.time):
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    with self._conn:
+      self._conn.execute('CREATE TABLE IF NOT EXISTS subjects ('
+                         ' primary_identifier TEXT PRIMARY KEY,'
+                         ' subject_num TEXT,'
+                         ' last_name TEXT,'
+                         ' first_name TEXT,'
+                         ' birthdate TEXT,'
+                         ' gender TEXT,'
+                         ' races TEXT,'
+                         ' ethnicity TEXT,'
+                         ' record_exists INTEGER,'
+                         ' fetched REAL)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS subjects_subject_num'
+                         ' ON subjects (subject_num)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS subjects_fetched'
+                         ' ON subjects (fetched)')
+
+  def __len__(self):
+    with self._lock:
+      return self._conn.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+
+  def close(self):
+    self._conn.close()
+
+  #----------------------------------------------------------------------------
+  # loading
+
+  def _store(self, primary_id, subject, fetched):
+    self._conn.execute(
+      'INSERT OR REPLACE INTO subjects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+      (primary_id, subject.subject_num, subject.last_name,
+       subject.first_name, subject.birthdate, subject.gender,
+       json.dumps(list(subject.races)), subject.ethnicity,
+       int(subject.exists), fetched))
+
+  def load(self, spec, primary_ids, max_workers=DEFAULT_MAX_WORKERS,
+           commit_every=500):
+    '''Looks up primary_ids in OnCore concurrently and stores the
+    results, committing every commit_every records. Subjects without an
+    OnCore record are stored too, so they can be answered from the
+    mirror as well. Lookups that failed (an exception, or a response
+    without the subject such as a SOAP fault) leave what's stored
+    untouched; returns a map of their primary id -> exception.'''
+    errors = {}
+    stored = 0
+    try:
+      for primary_id, subject_data, error in get_subject_data_many(
+          spec, primary_ids, max_workers):
+        if error is None:
+          try:
+            subject = to_subject(subject_data, drop_raw=True)
+          except (KeyError, expat.ExpatError) as e:
+            error = e
+        if error is not None:
+          errors[primary_id] = error
+          continue
+        with self._lock:
+          self._store(primary_id, subject, self._clock())
+          stored += 1
+          if stored % commit_every == 0:
+            self._conn.commit()
+    finally:
+      with self._lock:
+        self._conn.commit()
+    return errors
+
+  def stale_ids(self, max_age):
+    '''Primary identifiers fetched more than max_age seconds ago.'''
+    with self._lock:
+      rows = self._conn.execute('SELECT primary_identifier FROM subjects'
+                                ' WHERE fetched < ?',
+                                (self._clock() - max_age,)).fetchall()
+    return [row[0] for row in rows]
+
+  def refresh(self, spec, max_age, max_workers=DEFAULT_MAX_WORKERS):
+    '''Re-fetches only records older than max_age seconds. Returns
+    load's error map.'''
+    return self.load(spec, self.stale_ids(max_age), max_workers)
+
+  #----------------------------------------------------------------------------
+  # queries
+
+  def _query_one(self, column, value):
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT subject_num, last_name, first_name, birthdate, gender,'
+        ' races, ethnicity, record_exists, primary_identifier'
+        ' FROM subjects WHERE %s = ?' % column, (value,)).fetchone()
+    if row is None:
+      return None
+    return Subject(primary_identifier=(row[8] if row[7] else None),
+                   subject_num=row[0], last_name=row[1], first_name=row[2],
+                   birthdate=row[3], gender=row[4],
+                   races=tuple(json.loads(row[5])), ethnicity=row[6],
+                   exists=bool(row[7]))
+
+  def get(self, primary_id):
+    '''Returns the mirrored Subject, or None if not in the mirror.'''
+    return self._query_one('primary_identifier', primary_id)
+
+  def get_by_subject_num(self, subject_num):
+    return self._query_one('subject_num', subject_num)
+
+  def subject_record_exists(self, primary_id):
+    '''As core.subject_record_exists, but None if the mirror doesn't
+    know this primary identifier.'''
+    subject = self.get(primary_id)
+    return None if subject is None else subject.exists
+
+  def prep_subject_data(self, primary_id):
+    '''As core.prep_subject_data, or None if the mirror doesn't have an
+    existing OnCore record for this primary identifier.'''
+    subject = self.get(primary_id)
+    if subject is None or not subject.exists:
+      return None
+    return subject.prepped()
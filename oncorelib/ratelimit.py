@@ -0,0 +1,92 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+__all__ = ['RateLimiter']
+
+#------------------------------------------------------------------------------
+# client-side rate limiting
+
+class RateLimiter(object):
+  '''Thread-safe token bucket shaping traffic to OnCore. Each request
+  takes one token; tokens refill at rate per second up to burst. If
+  max_in_flight is set, at most that many requests run at once.
+  Share one instance between clients to shape a whole process.
+  Use as a context manager around each request, or call acquire and
+  release to bound the wait.
+  '''
+
+  def __init__(self, rate, burst=None, max_in_flight=None,
+               clock=time.time, sleep=time.sleep):
+    self.rate = float(rate)
+    self.burst = burst if burst is not None else max(1, int(rate))
+    self.max_in_flight = max_in_flight
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = float(self.burst)
+    self._last = clock()
+    self._lock = threading.Lock()
+    self._in_flight = 0
+    self._slot_free = threading.Condition(threading.Lock())
+
+  def _take_slot(self, deadline):
+    with self._slot_free:
+      while self._in_flight >= self.max_in_flight:
+        if deadline is None:
+          self._slot_free.wait()
+          continue
+        remaining = deadline - self._clock()
+        if remaining <= 0:
+          return False
+        self._slot_free.wait(remaining)
+      self._in_flight += 1
+      return True
+
+  def _release_slot(self):
+    with self._slot_free:
+      self._in_flight -= 1
+      self._slot_free.notify()
+
+  def _take_token(self, deadline):
+    while True:
+      with self._lock:
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return True
+        wait = (1 - self._tokens) / self.rate
+      if deadline is not None and now + wait > deadline:
+        return False
+      self._sleep(wait)
+
+  def acquire(self, deadline=None):
+    '''Waits for an in-flight slot and a token. deadline is an absolute
+    time (per the limiter's clock); returns False, holding nothing, if
+    they can't be had by then, otherwise True.'''
+    if self.max_in_flight and not self._take_slot(deadline):
+      return False
+    try:
+      taken = self._take_token(deadline)
+    except BaseException:
+      self.release()
+      raise
+    if not taken:
+      self.release()
+    return taken
+
+  def release(self):
+    '''Gives back the in-flight slot taken by acquire.'''
+    if self.max_in_flight:
+      self._release_slot()
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.release()
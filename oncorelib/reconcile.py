@@ -0,0 +1,104 @@
+from __future__ import division
+from __future__ import print_function
+
+from collections import namedtuple
+import csv
+from itertools import islice
+import json
+from xml.parsers import expat
+
+from batch import get_subject_data_many, DEFAULT_MAX_WORKERS
+from core import to_subject
+
+__all__ = ['Mismatch', 'read_csv_records', 'read_jsonl_records',
+           'normalize_value', 'normalize', 'reconcile_roster']
+
+#------------------------------------------------------------------------------
+# roster reconciliation
+
+FIELDS = ['last-name', 'first-name', 'birthdate', 'gender', 'races',
+          'ethnicity']
+
+class Mismatch(namedtuple('Mismatch', ['primary_identifier', 'kind',
+                                       'field', 'local', 'oncore'])):
+  '''One difference found by reconcile. kind is:
+    o 'field': field differs; local and oncore hold the two values
+    o 'missing': no OnCore record for this primary identifier
+    o 'error': the lookup failed (an exception, or a response without
+       the subject such as a SOAP fault); oncore holds the exception
+       (a core.ResponseError for bad responses)
+  '''
+  __slots__ = ()
+
+def read_csv_records(f, races_separator=';'):
+  '''Yields local records from a CSV file object whose header uses the
+  prep_subject_data keys (e.g. primary-identifier, last-name); races
+  are split on races_separator.'''
+  for row in csv.DictReader(f):
+    record = dict((k, v.decode('utf_8') if type(v) == str else v)
+                  for k, v in row.items())
+    if record.get('races'):
+      record['races'] = record['races'].split(races_separator)
+    yield record
+
+def read_jsonl_records(f):
+  '''Yields local records from a file object with one JSON map per line,
+  keyed like prep_subject_data.'''
+  for line in f:
+    if line.strip():
+      yield json.loads(line)
+
+def normalize_value(value):
+  '''Default comparison form: strings stripped and lower-cased, empty
+  values as None, and lists (races) as sorted lists of the same.'''
+  if isinstance(value, (list, tuple)):
+    return sorted(v for v in map(normalize_value, value) if v is not None)
+  if value is None:
+    return None
+  value = unicode(value).strip().lower()
+  return value or None
+
+def normalize(record, fields=FIELDS, normalizers=None):
+  '''Returns record reduced to fields, in prep_subject_data shape, with
+  every value normalised (normalizers may map a field to its own
+  function, e.g. to reformat birthdates).'''
+  normalizers = normalizers or {}
+  return dict((field, normalizers.get(field, normalize_value)(
+                 record.get(field)))
+              for field in fields)
+
+def reconcile_roster(spec, local_records, fields=FIELDS, normalizers=None,
+                     batch_size=200, max_workers=DEFAULT_MAX_WORKERS):
+  '''Compares local demographic records (e.g. from read_csv_records or
+  read_jsonl_records) against OnCore and yields a Mismatch per
+  difference. Records are consumed batch_size at a time and each
+  batch's subjects are looked up concurrently, so memory stays bounded
+  however long the roster is.'''
+  records = iter(local_records)
+  while True:
+    batch = list(islice(records, batch_size))
+    if not batch:
+      return
+    by_id = {}
+    for record in batch:
+      by_id.setdefault(record['primary-identifier'], []).append(record)
+    for primary_id, subject_data, error in get_subject_data_many(
+        spec, list(by_id), max_workers):
+      if error is None:
+        try:
+          subject = to_subject(subject_data, drop_raw=True)
+        except (KeyError, expat.ExpatError) as e:
+          error = e
+      if error is not None:
+        yield Mismatch(primary_id, 'error', None, None, error)
+        continue
+      if not subject.exists:
+        yield Mismatch(primary_id, 'missing', None, None, None)
+        continue
+      oncore = normalize(subject.prepped(), fields, normalizers)
+      for record in by_id[primary_id]:
+        local = normalize(record, fields, normalizers)
+        for field in fields:
+          if local[field] != oncore[field]:
+            yield Mismatch(primary_id, 'field', field, local[field],
+                           oncore[field])
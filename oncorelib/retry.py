@@ -0,0 +1,88 @@
+from __future__ import division
+from __future__ import print_function
+
+import random
+import time
+
+import requests
+
+__all__ = ['IDEMPOTENT_OPS', 'DeadlineExceeded', 'RetryPolicy']
+
+#------------------------------------------------------------------------------
+# retries
+
+IDEMPOTENT_OPS = ('get_protocol', 'get_subject_data')
+
+class DeadlineExceeded(requests.Timeout):
+  '''Raised when a call's deadline passes before it could complete.'''
+
+class RetryPolicy(object):
+  '''Retries failed OnCore calls with jittered exponential backoff.
+  Args:
+    o max_attempts: total tries per call, including the first
+    o backoff: base delay in seconds; before retry n the client sleeps a
+       random time between 0 and min(max_backoff, backoff * 2**(n-1))
+       ("full jitter"), so concurrent workers don't retry in lockstep
+    o retry_statuses: HTTP status codes that trigger a retry
+    o retry_exceptions: exception types that trigger a retry
+    o deadline: overall seconds allowed per call across all attempts;
+       no retry is started that would sleep past it
+    o retry_registrations: registrations aren't idempotent, so they
+       are only retried if this is True
+  '''
+
+  def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30,
+               retry_statuses=(502, 503, 504),
+               retry_exceptions=(requests.ConnectionError, requests.Timeout),
+               deadline=None, retry_registrations=False,
+               sleep=time.sleep, clock=time.time):
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.retry_statuses = frozenset(retry_statuses)
+    self.retry_exceptions = tuple(retry_exceptions)
+    self.deadline = deadline
+    self.retry_registrations = retry_registrations
+    self._sleep = sleep
+    self._clock = clock
+
+  def applies_to(self, op):
+    if op in IDEMPOTENT_OPS:
+      return True
+    return self.retry_registrations and op == 'register_subject_to_protocol'
+
+  def delay(self, attempt):
+    '''Sleep before the retry following the given (1-based) attempt.'''
+    cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+  def _can_retry(self, attempt, delay, deadline):
+    if attempt >= self.max_attempts:
+      return False
+    return deadline is None or self._clock() + delay < deadline
+
+  def run(self, send, deadline=None):
+    '''Calls send() until it returns a response whose status isn't
+    retryable, or attempts or time run out; then returns the last
+    response or re-raises the last exception. deadline is an absolute
+    time (per the policy's clock); the earlier of it and now +
+    self.deadline applies.'''
+    if self.deadline is not None:
+      own_deadline = self._clock() + self.deadline
+      deadline = (own_deadline if deadline is None
+                  else min(deadline, own_deadline))
+    attempt = 1
+    while True:
+      delay = self.delay(attempt)
+      try:
+        response = send()
+      except self.retry_exceptions:
+        if not self._can_retry(attempt, delay, deadline):
+          raise
+      else:
+        if (response.status_code not in self.retry_statuses
+            or not self._can_retry(attempt, delay, deadline)):
+          return response
+        response.close()
+      self._sleep(delay)
+      attempt += 1
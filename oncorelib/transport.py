@@ -0,0 +1,136 @@
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import gzip
+import json
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+__all__ = ['ReplayResponse', 'RecordingTransport', 'read_archive',
+           'ReplayTransport']
+
+#------------------------------------------------------------------------------
+# record and replay
+#
+# An archive is a gzip file of records, each a JSON header line followed
+# by the raw request bytes and then the raw response bytes, with their
+# lengths given in the header.
+
+class ReplayResponse(object):
+  '''Response-like object served from a recorded archive; supports what
+  Client uses of a requests Response.'''
+
+  def __init__(self, status_code, headers, content, elapsed):
+    self.status_code = status_code
+    self.headers = CaseInsensitiveDict(headers)
+    self.content = content
+    self.elapsed = datetime.timedelta(seconds=elapsed)
+
+  def iter_content(self, chunk_size=1):
+    for i in range(0, len(self.content), chunk_size):
+      yield self.content[i:i + chunk_size]
+
+  def close(self):
+    pass
+
+def _header_subset(headers):
+  return dict((k, headers[k]) for k in ('content-type', 'content-length')
+              if k in headers)
+
+class RecordingTransport(object):
+  '''Wraps another transport, normally the recording client's session
+  so that its connection pool settings still apply (see
+  core.record_transport), and appends every request envelope and raw
+  response, multipart framing included, to a gzip archive at path.
+  Responses are read in full before being handed back, so stream mode
+  parses from memory while recording.
+  '''
+
+  def __init__(self, path, inner):
+    self.inner = inner
+    self._file = gzip.open(path, 'ab')
+    self._lock = threading.Lock()
+
+  def post(self, url, data=None, **kwargs):
+    started = time.time()
+    response = self.inner.post(url, data=data, **kwargs)
+    content = response.content
+    elapsed = time.time() - started
+    headers = _header_subset(response.headers)
+    header = json.dumps({'url': url, 'status': response.status_code,
+                         'headers': headers, 'elapsed': elapsed,
+                         'request-length': len(data),
+                         'response-length': len(content)})
+    with self._lock:
+      self._file.write(header.encode('utf_8') + b'\n')
+      self._file.write(data)
+      self._file.write(content)
+    response.close()
+    return ReplayResponse(response.status_code, headers, content, elapsed)
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+def read_archive(path):
+  '''Yields (header map, request bytes, response bytes) per record.'''
+  f = gzip.open(path, 'rb')
+  try:
+    while True:
+      line = f.readline()
+      if not line:
+        return
+      header = json.loads(line.decode('utf_8'))
+      request = f.read(header['request-length'])
+      response = f.read(header['response-length'])
+      yield header, request, response
+  finally:
+    f.close()
+
+class ReplayTransport(object):
+  '''Serves responses from an archive written by RecordingTransport.
+  A request is answered with the recorded response to an identical
+  envelope if there is one (cycling through repeats), otherwise with
+  the next recorded response in order, so a recording can be replayed
+  against a different request mix. speed scales the recorded response
+  times (2.0 replays twice as fast); None serves without delay.'''
+
+  def __init__(self, path, speed=1.0):
+    self.speed = speed
+    self._records = []
+    self._by_request = {}  # request bytes -> [record index]
+    for header, request, response in read_archive(path):
+      self._by_request.setdefault(request, []).append(len(self._records))
+      self._records.append((header, response))
+    if not self._records:
+      raise ValueError('empty archive: %s' % path)
+    self._next = 0
+    self._next_by_request = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._records)
+
+  def _pick(self, data):
+    with self._lock:
+      matches = self._by_request.get(data)
+      if matches:
+        n = self._next_by_request.get(data, 0)
+        self._next_by_request[data] = n + 1
+        return self._records[matches[n % len(matches)]]
+      record = self._records[self._next % len(self._records)]
+      self._next += 1
+      return record
+
+  def post(self, url, data=None, **kwargs):
+    header, response = self._pick(data)
+    if self.speed:
+      time.sleep(header['elapsed'] / self.speed)
+    return ReplayResponse(header['status'], header['headers'], response,
+                          header['elapsed'])
+
+  def close(self):
+    pass
@@ -0,0 +1,70 @@
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import re
+import threading
+
+from oncorelib.transport import ReplayResponse
+
+#------------------------------------------------------------------------------
+# canned OnCore responses
+
+_ENVELOPE = (b'<soap:Envelope'
+             b' xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"'
+             b' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+             b'<soap:Body>%s</soap:Body></soap:Envelope>')
+
+def subject_xml(primary_id, subject_num):
+  return _ENVELOPE % (
+    b'<ns7:Subject xmlns:ns7="http://subject">'
+    b'<PrimaryIdentifier>' + primary_id.encode('utf_8') +
+    b'</PrimaryIdentifier><SubjectNo>' + subject_num.encode('utf_8') +
+    b'</SubjectNo><LastName>Lee</LastName><FirstName>Ann</FirstName>'
+    b'<BirthDate>1980-01-01</BirthDate><Gender>Female</Gender>'
+    b'<Race>White</Race><Ethnicity>Unknown</Ethnicity></ns7:Subject>')
+
+NO_SUBJECT_XML = _ENVELOPE % (b'<ns7:Subject xmlns:ns7="http://subject"'
+                              b' xsi:nil="true"/>')
+
+FAULT_XML = _ENVELOPE % (b'<soap:Fault><faultcode>soap:Server</faultcode>'
+                         b'<faultstring>boom</faultstring></soap:Fault>')
+
+REGISTERED_XML = _ENVELOPE % b'<ns2:registered xmlns:ns2="http://subject"/>'
+
+_PRIMARY_ID_RE = re.compile(u'<PrimaryIdentifier>(.*?)</PrimaryIdentifier>')
+
+def primary_id_of(envelope):
+  return _PRIMARY_ID_RE.search(envelope).group(1)
+
+def is_registration(envelope):
+  return u'SubjectRegistrationData' in envelope
+
+_urls = itertools.count()
+
+def make_spec():
+  '''A spec of its own, so every test gets fresh default clients.'''
+  return {'user': 'user', 'password': 'password',
+          'service-url': 'http://oncore.test/%d' % next(_urls)}
+
+#------------------------------------------------------------------------------
+
+class FakeTransport(object):
+  '''Transport for Client that answers each POST with
+  handler(envelope) -> (status code, body bytes) and keeps the
+  envelopes sent, in order, in sent.'''
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.sent = []
+    self._lock = threading.Lock()
+
+  def post(self, url, data=None, **kwargs):
+    envelope = data.decode('utf_8')
+    with self._lock:
+      self.sent.append(envelope)
+    status_code, body = self.handler(envelope)
+    return ReplayResponse(status_code, {'content-type': 'text/xml'}, body, 0)
+
+  def registrations(self):
+    return [envelope for envelope in self.sent if is_registration(envelope)]
@@ -0,0 +1,34 @@
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+
+import oncorelib
+from tests import fakes
+
+class AsyncClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sent = []
+
+  def handle(self, envelope):
+    self.sent.append(envelope)
+    time.sleep(0.2)
+    return 200, fakes.subject_xml(fakes.primary_id_of(envelope), u'S1')
+
+  def test_deadline_counts_time_queued(self):
+    client = oncorelib.AsyncClient(fakes.make_spec(), max_in_flight=1,
+                                   transport=fakes.FakeTransport(self.handle))
+    with client:
+      handles = [client.get_subject_data(primary_id, deadline=0.3)
+                 for primary_id in (u'1', u'2', u'3')]
+      self.assertEqual(handles[0].get(5)['status-code'], 200)
+      # queued 0.2s, leaving 0.1s for a 0.2s call
+      self.assertRaises(oncorelib.DeadlineExceeded, handles[1].get, 5)
+      # out of time before it leaves the queue
+      self.assertRaises(oncorelib.DeadlineExceeded, handles[2].get, 5)
+    self.assertEqual(len(self.sent), 2)
+
+if __name__ == '__main__':
+  unittest.main()
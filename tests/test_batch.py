@@ -0,0 +1,139 @@
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import requests
+
+import oncorelib
+from oncorelib.batch import ensure_registered
+from tests import fakes
+
+def reg_data(primary_id, protocol_num=u'P1'):
+  return {'context': u'ctx', 'protocol-num': protocol_num,
+          'study-site': u'Site',
+          'primary-identifier': primary_id, 'last-name': u'Lee',
+          'first-name': u'Ann', 'birthdate': u'1980-01-01',
+          'gender': u'Female', 'ethnicity': u'Unknown', 'races': [u'White']}
+
+class EnsureRegisteredTest(unittest.TestCase):
+
+  def setUp(self):
+    self.spec = fakes.make_spec()
+    self.lookups = {}  # primary id -> (status code, body) or exception
+    self.registered = {}  # primary id -> SubjectNo OnCore gives it
+
+  def tearDown(self):
+    oncorelib.close_clients()
+
+  def handle(self, envelope):
+    if fakes.is_registration(envelope):
+      primary_id = fakes.primary_id_of(envelope)
+      if primary_id in self.registered:
+        self.lookups[primary_id] = 200, fakes.subject_xml(
+          primary_id, self.registered[primary_id])
+      return 200, fakes.REGISTERED_XML
+    lookup = self.lookups[fakes.primary_id_of(envelope)]
+    if isinstance(lookup, Exception):
+      raise lookup
+    return lookup
+
+  def run_batch(self, primary_ids, protocol_nums=None):
+    transport = fakes.FakeTransport(self.handle)
+    oncorelib.set_transport(self.spec, transport)
+    protocol_nums = protocol_nums or [u'P1'] * len(primary_ids)
+    records = [reg_data(primary_id, protocol_num) for primary_id, protocol_num
+               in zip(primary_ids, protocol_nums)]
+    outcomes = ensure_registered(self.spec, records, max_workers=2)
+    return outcomes, transport
+
+  def test_existing_and_new_subjects(self):
+    self.lookups[u'1'] = 200, fakes.subject_xml(u'1', u'S1')
+    self.lookups[u'2'] = 200, fakes.NO_SUBJECT_XML
+    outcomes, transport = self.run_batch([u'1', u'2'])
+    self.assertEqual([o['status'] for o in outcomes], ['success', 'success'])
+    registrations = sorted(transport.registrations(), key=fakes.primary_id_of)
+    self.assertIn(u'<SubjectNo>S1</SubjectNo>', registrations[0])
+    self.assertIn(u'ProtocolExistingSubject', registrations[0])
+    self.assertIn(u'ProtocolNewSubject', registrations[1])
+
+  def test_new_subject_in_several_protocols_is_registered_once(self):
+    self.lookups[u'1'] = 200, fakes.NO_SUBJECT_XML
+    self.registered[u'1'] = u'S9'
+    outcomes, transport = self.run_batch([u'1', u'1', u'1'],
+                                         [u'P1', u'P2', u'P3'])
+    self.assertEqual([o['status'] for o in outcomes], ['success'] * 3)
+    registrations = transport.registrations()
+    self.assertEqual(len(registrations), 3)
+    self.assertIn(u'ProtocolNewSubject', registrations[0])
+    for envelope in registrations[1:]:
+      self.assertIn(u'ProtocolExistingSubject', envelope)
+      self.assertIn(u'<SubjectNo>S9</SubjectNo>', envelope)
+
+  def test_new_subject_not_found_after_registering_is_retried_as_new(self):
+    # OnCore took the registration but has no record of it afterwards
+    self.lookups[u'1'] = 200, fakes.NO_SUBJECT_XML
+    outcomes, transport = self.run_batch([u'1', u'1'], [u'P1', u'P2'])
+    self.assertEqual([o['status'] for o in outcomes], ['success'] * 2)
+    for envelope in transport.registrations():
+      self.assertIn(u'ProtocolNewSubject', envelope)
+
+  def test_failed_lookup_after_registering_is_lookup_error(self):
+    self.lookups[u'1'] = 200, fakes.NO_SUBJECT_XML
+    self.registered[u'1'] = u'S9'
+    def handle(envelope):
+      result = EnsureRegisteredTest.handle(self, envelope)
+      if fakes.is_registration(envelope):
+        self.lookups[u'1'] = requests.ConnectionError('refused')
+      return result
+    self.handle = handle
+    outcomes, transport = self.run_batch([u'1', u'1'], [u'P1', u'P2'])
+    self.assertEqual([o['status'] for o in outcomes],
+                     ['success', 'lookup-error'])
+    self.assertEqual(len(transport.registrations()), 1)
+
+  def assertLookupError(self, lookup):
+    self.lookups[u'1'] = lookup
+    self.lookups[u'2'] = 200, fakes.NO_SUBJECT_XML
+    outcomes, transport = self.run_batch([u'1', u'2'])
+    self.assertEqual(outcomes[0]['status'], 'lookup-error')
+    self.assertIsNotNone(outcomes[0]['error'])
+    self.assertEqual(outcomes[1]['status'], 'success')
+    self.assertEqual([fakes.primary_id_of(envelope)
+                      for envelope in transport.registrations()], [u'2'])
+    return outcomes[0]['error']
+
+  def test_soap_fault_is_lookup_error(self):
+    error = self.assertLookupError((500, fakes.FAULT_XML))
+    self.assertEqual(error.status_code, 500)
+
+  def test_unavailable_is_lookup_error(self):
+    error = self.assertLookupError((503, b''))
+    self.assertEqual(error.status_code, 503)
+
+  def test_unparseable_body_is_lookup_error(self):
+    self.assertLookupError((200, b'<soap:Envelope><soap:Bo'))
+
+  def test_body_without_subject_is_lookup_error(self):
+    self.assertLookupError((200, fakes.REGISTERED_XML))
+
+  def test_existing_subject_without_subject_num_is_lookup_error(self):
+    body = fakes.subject_xml(u'1', u'S1').replace(
+      b'<SubjectNo>S1</SubjectNo>', b'')
+    self.assertLookupError((200, body))
+
+  def test_request_exception_is_lookup_error(self):
+    error = self.assertLookupError(requests.ConnectionError('refused'))
+    self.assertIsInstance(error, requests.ConnectionError)
+
+  def test_invalid_records_are_skipped(self):
+    self.lookups[u'1'] = 200, fakes.NO_SUBJECT_XML
+    transport = fakes.FakeTransport(self.handle)
+    oncorelib.set_transport(self.spec, transport)
+    invalid = dict(reg_data(u'2'), gender=None)
+    outcomes = ensure_registered(self.spec, [invalid, reg_data(u'1')])
+    self.assertEqual([o['status'] for o in outcomes], ['invalid', 'success'])
+    self.assertEqual(len(transport.registrations()), 1)
+
+if __name__ == '__main__':
+  unittest.main()
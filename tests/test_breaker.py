@@ -0,0 +1,178 @@
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+
+import requests
+
+import oncorelib
+from oncorelib.breaker import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker,
+                               CircuitOpenError)
+from tests import fakes
+
+class Response(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+class Clock(object):
+  def __init__(self):
+    self.now = 1000.0
+  def __call__(self):
+    return self.now
+
+def fail():
+  raise requests.ConnectionError('refused')
+
+class CircuitBreakerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30,
+                                  clock=self.clock)
+
+  def trip(self):
+    for _ in range(3):
+      self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+
+  def test_opens_after_consecutive_failures(self):
+    for _ in range(2):
+      self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+    self.assertEqual(self.breaker.state, CLOSED)
+    self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+    self.assertEqual(self.breaker.state, OPEN)
+
+  def test_success_resets_consecutive_failures(self):
+    for _ in range(2):
+      self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+    self.breaker.call(lambda: Response(200))
+    for _ in range(2):
+      self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_open_circuit_fails_fast(self):
+    self.trip()
+    calls = []
+    self.assertRaises(CircuitOpenError, self.breaker.call,
+                      lambda: calls.append(1))
+    self.assertEqual(calls, [])
+
+  def test_half_open_probe_success_closes(self):
+    self.trip()
+    self.clock.now += 30
+    self.assertEqual(self.breaker.state, HALF_OPEN)
+    self.breaker.call(lambda: Response(200))
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_half_open_probe_failure_reopens(self):
+    self.trip()
+    self.clock.now += 30
+    self.assertRaises(requests.ConnectionError, self.breaker.call, fail)
+    self.assertEqual(self.breaker.state, OPEN)
+    self.clock.now += 29
+    self.assertEqual(self.breaker.state, OPEN)
+
+  def test_half_open_lets_one_probe_through(self):
+    self.trip()
+    self.clock.now += 30
+    def probe():
+      self.assertRaises(CircuitOpenError, self.breaker.call,
+                        lambda: Response(200))
+      return Response(200)
+    self.breaker.call(probe)
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_failure_statuses(self):
+    for _ in range(3):
+      self.breaker.call(lambda: Response(503))
+    self.assertEqual(self.breaker.state, OPEN)
+
+  def test_soap_faults_are_not_failures(self):
+    for _ in range(5):
+      self.breaker.call(lambda: Response(500))
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_failure_rate(self):
+    breaker = CircuitBreaker(failure_threshold=100, failure_rate=0.5,
+                             window=4, clock=self.clock)
+    for status in (200, 503, 200):
+      breaker.call(lambda: Response(status))
+    self.assertEqual(breaker.state, CLOSED)
+    breaker.call(lambda: Response(503))
+    self.assertEqual(breaker.state, OPEN)
+
+  def test_ignored_exceptions_are_not_recorded(self):
+    for _ in range(5):
+      self.assertRaises(requests.ConnectionError, self.breaker.call, fail,
+                        (requests.ConnectionError,))
+    self.assertEqual(self.breaker.state, CLOSED)
+    self.assertEqual(self.breaker.stats()['consecutive-failures'], 0)
+
+  def test_ignored_exception_abandons_probe(self):
+    self.trip()
+    self.clock.now += 30
+    self.assertRaises(requests.ConnectionError, self.breaker.call, fail,
+                      (requests.ConnectionError,))
+    self.assertEqual(self.breaker.state, HALF_OPEN)
+    self.breaker.call(lambda: Response(200))
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_reset(self):
+    self.trip()
+    self.breaker.reset()
+    self.assertEqual(self.breaker.state, CLOSED)
+
+class ClientBreakerTest(unittest.TestCase):
+  '''The breaker as the client drives it.'''
+
+  def setUp(self):
+    self.breaker = CircuitBreaker(failure_threshold=3)
+
+  def tearDown(self):
+    oncorelib.close_clients()
+
+  def client(self, handler, **kwargs):
+    return oncorelib.Client(fakes.make_spec(),
+                            transport=fakes.FakeTransport(handler),
+                            circuit_breaker=self.breaker, **kwargs)
+
+  def test_soap_faults_leave_circuit_closed(self):
+    client = self.client(lambda envelope: (500, fakes.FAULT_XML))
+    for _ in range(5):
+      self.assertEqual(client.get_subject_data(u'1')['status-code'], 500)
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_unavailable_opens_circuit(self):
+    client = self.client(lambda envelope: (503, b''))
+    for _ in range(3):
+      client.get_subject_data(u'1')
+    self.assertEqual(self.breaker.state, OPEN)
+    self.assertRaises(CircuitOpenError, client.get_subject_data, u'1')
+
+  def test_expired_deadline_is_not_a_failure(self):
+    client = self.client(lambda envelope: (200, fakes.NO_SUBJECT_XML))
+    for _ in range(5):
+      self.assertRaises(oncorelib.DeadlineExceeded, client.get_subject_data,
+                        u'1', deadline=0)
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_timeout_cut_by_deadline_is_not_a_failure(self):
+    def handler(envelope):
+      time.sleep(0.02)
+      raise requests.ReadTimeout('read timed out')
+    client = self.client(handler, read_timeout=60)
+    for _ in range(5):
+      self.assertRaises(oncorelib.DeadlineExceeded, client.get_subject_data,
+                        u'1', deadline=0.01)
+    self.assertEqual(self.breaker.state, CLOSED)
+
+  def test_timeout_without_deadline_is_a_failure(self):
+    def handler(envelope):
+      raise requests.ReadTimeout('read timed out')
+    client = self.client(handler, read_timeout=60)
+    for _ in range(3):
+      self.assertRaises(requests.ReadTimeout, client.get_subject_data, u'1')
+    self.assertEqual(self.breaker.state, OPEN)
+
+if __name__ == '__main__':
+  unittest.main()
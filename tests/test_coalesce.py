@@ -0,0 +1,177 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import requests
+
+import oncorelib
+from oncorelib.coalesce import SingleFlight
+from oncorelib.retry import DeadlineExceeded
+from tests import fakes
+
+class Call(threading.Thread):
+  '''Runs fn on a thread, keeping its result or exception.'''
+
+  def __init__(self, fn, *args):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.fn = fn
+    self.args = args
+    self.result = None
+    self.error = None
+
+  def run(self):
+    try:
+      self.result = self.fn(*self.args)
+    except Exception as e:
+      self.error = e
+
+  def finish(self):
+    self.join(5)
+    return self
+
+class SingleFlightTest(unittest.TestCase):
+
+  def setUp(self):
+    self.flight = SingleFlight()
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.calls = []
+
+  def leader_fn(self, outcome='result'):
+    def fn():
+      self.calls.append('leader')
+      self.started.set()
+      self.release.wait(5)
+      if isinstance(outcome, Exception):
+        raise outcome
+      return {'value': outcome}
+    return fn
+
+  def follower_fn(self):
+    self.calls.append('follower')
+    return {'value': 'own'}
+
+  def lead(self, outcome='result', deadline=None):
+    leader = Call(self.flight.do, 'key', self.leader_fn(outcome), deadline,
+                  dict)
+    leader.start()
+    self.assertTrue(self.started.wait(5))
+    return leader
+
+  def follow(self, deadline=None):
+    follower = Call(self.flight.do, 'key', self.follower_fn, deadline, dict)
+    follower.start()
+    time.sleep(0.05)  # let it start waiting
+    return follower
+
+  def test_followers_share_the_call(self):
+    leader = self.lead()
+    followers = [self.follow() for _ in range(3)]
+    self.release.set()
+    results = [call.finish().result for call in [leader] + followers]
+    self.assertEqual(self.calls, ['leader'])
+    self.assertEqual(results, [{'value': 'result'}] * 4)
+
+  def test_each_caller_gets_a_copy(self):
+    leader = self.lead()
+    follower = self.follow()
+    self.release.set()
+    leader.finish().result['value'] = 'changed'
+    self.assertEqual(follower.finish().result, {'value': 'result'})
+
+  def test_follower_waits_no_longer_than_its_deadline(self):
+    leader = self.lead()
+    started = time.time()
+    follower = Call(self.flight.do, 'key', self.follower_fn,
+                    time.time() + 0.1)
+    follower.start()
+    follower.join(1)
+    self.assertIsInstance(follower.error, DeadlineExceeded)
+    self.assertLess(time.time() - started, 0.5)
+    self.release.set()
+    self.assertEqual(leader.finish().result, {'value': 'result'})
+
+  def test_leader_deadline_is_not_shared_with_follower_without_one(self):
+    leader = self.lead(DeadlineExceeded('leader ran out'), time.time() + 5)
+    follower = self.follow()
+    self.release.set()
+    self.assertIsInstance(leader.finish().error, DeadlineExceeded)
+    follower.finish()
+    self.assertIsNone(follower.error)
+    self.assertEqual(follower.result, {'value': 'own'})
+    self.assertEqual(self.calls, ['leader', 'follower'])
+
+  def test_leader_deadline_is_not_shared_with_later_deadline(self):
+    now = time.time()
+    self.lead(DeadlineExceeded('leader ran out'), now + 1)
+    follower = self.follow(now + 5)
+    self.release.set()
+    self.assertEqual(follower.finish().result, {'value': 'own'})
+
+  def test_leader_deadline_is_shared_with_same_deadline(self):
+    deadline = time.time() + 5
+    self.lead(DeadlineExceeded('leader ran out'), deadline)
+    follower = self.follow(deadline)
+    self.release.set()
+    self.assertIsInstance(follower.finish().error, DeadlineExceeded)
+    self.assertEqual(self.calls, ['leader'])
+
+  def test_other_errors_are_shared(self):
+    error = requests.ConnectionError('refused')
+    self.lead(error)
+    follower = self.follow()
+    self.release.set()
+    self.assertIs(follower.finish().error, error)
+    self.assertEqual(self.calls, ['leader'])
+
+class ClientCoalescingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.delay = 0.3
+    self.sent = []
+    self.client = oncorelib.Client(fakes.make_spec(), coalesce=True,
+                                   transport=fakes.FakeTransport(self.handle))
+
+  def handle(self, envelope):
+    self.sent.append(envelope)
+    time.sleep(self.delay)
+    return 200, fakes.subject_xml(u'1', u'S1')
+
+  def lookup(self, deadline=None):
+    call = Call(self.client.get_subject_data, u'1', deadline)
+    call.start()
+    time.sleep(0.05)
+    return call
+
+  def test_dropping_raw_data_leaves_other_callers_alone(self):
+    first, second = self.lookup(), self.lookup()
+    results = [first.finish().result, second.finish().result]
+    self.assertEqual(len(self.sent), 1)
+    subject = oncorelib.to_subject(results[0], drop_raw=True)
+    self.assertEqual(subject.subject_num, u'S1')
+    self.assertNotIn('xml', results[0])
+    self.assertEqual(oncorelib.to_subject(results[1]), subject)
+
+  def test_follower_deadline(self):
+    leader = self.lookup()
+    started = time.time()
+    follower = self.lookup(deadline=0.1)
+    self.assertIsInstance(follower.finish().error, DeadlineExceeded)
+    self.assertLess(time.time() - started, self.delay)
+    self.assertEqual(leader.finish().result['status-code'], 200)
+
+  def test_leader_timeout_not_shared_with_follower_without_deadline(self):
+    leader = self.lookup(deadline=0.1)
+    follower = self.lookup()
+    self.assertIsInstance(leader.finish().error, DeadlineExceeded)
+    follower.finish()
+    self.assertIsNone(follower.error)
+    self.assertEqual(follower.result['status-code'], 200)
+    self.assertEqual(len(self.sent), 2)
+
+if __name__ == '__main__':
+  unittest.main()
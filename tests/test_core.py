@@ -0,0 +1,104 @@
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import xmltodict
+
+from oncorelib.core import LazyResult, _read_streaming, _root_part
+from oncorelib.transport import ReplayResponse
+from tests import fakes
+
+def lazy_result():
+  return LazyResult(200, fakes.subject_xml(u'1', u'S1'))
+
+def keyword_args(**kwargs):
+  return kwargs
+
+class LazyResultTest(unittest.TestCase):
+
+  def setUp(self):
+    self.result = lazy_result()
+
+  def assertComplete(self, converted):
+    self.assertEqual(sorted(converted), ['status-code', 'structured-data',
+                                         'xml'])
+    self.assertIn('soap:Envelope', converted['structured-data'])
+
+  def test_status_code_and_xml_do_not_parse(self):
+    self.assertEqual(self.result['status-code'], 200)
+    self.assertIn('structured-data', self.result)
+    self.assertEqual(len(self.result), 3)
+    self.assertTrue(self.result._unparsed())
+
+  def test_dict_conversion_includes_structured_data(self):
+    self.assertComplete(dict(self.result))
+
+  def test_update_includes_structured_data(self):
+    converted = {}
+    converted.update(self.result)
+    self.assertComplete(converted)
+
+  def test_keyword_expansion_includes_structured_data(self):
+    self.assertComplete(keyword_args(**self.result))
+
+  def test_unparsed_results_compare_equal(self):
+    other = lazy_result()
+    self.assertEqual(self.result, other)
+    self.assertEqual(other, self.result)
+    self.assertFalse(self.result != other)
+
+  def test_compares_equal_to_plain_dict(self):
+    plain = dict(lazy_result())
+    self.assertEqual(self.result, plain)
+    self.assertEqual(plain, self.result)
+
+  def test_copy_does_not_parse(self):
+    copied = self.result.copy()
+    self.assertTrue(copied._unparsed())
+    self.assertTrue(self.result._unparsed())
+    self.assertComplete(dict(copied))
+
+  def test_deleting_unparsed_structured_data(self):
+    del self.result['structured-data']
+    self.assertNotIn('structured-data', self.result)
+    self.assertEqual(dict(self.result),
+                     {'status-code': 200,
+                      'xml': fakes.subject_xml(u'1', u'S1')})
+
+_MULTIPART_TYPE = ('multipart/related; type="application/xop+xml";'
+                   ' boundary="uuid:b1"')
+
+class ChunkedResponse(ReplayResponse):
+  '''Serves the body in the given pieces, whatever chunk size is asked
+  for.'''
+
+  def __init__(self, content_type, chunks):
+    ReplayResponse.__init__(self, 200, {'content-type': content_type},
+                            b''.join(chunks), 0)
+    self.chunks = chunks
+
+  def iter_content(self, chunk_size=1):
+    return iter(self.chunks)
+
+class StreamingTest(unittest.TestCase):
+
+  def test_multipart_in_small_chunks_matches_buffered(self):
+    root = fakes.subject_xml(u'1', u'S1')
+    body = (b'--uuid:b1\r\nContent-Type: application/xop+xml\r\n\r\n' +
+            root + b'\r\n--uuid:b1\r\nContent-Type: application/pdf\r\n'
+            b'\r\nATTACHMENT\r\n--uuid:b1--\r\n')
+    end = body.index(b'\r\n--uuid:b1')
+    # 9-byte pieces, then one ending midway through the closing boundary
+    cuts = sorted(set(list(range(0, end, 9)) + [end + 5, len(body)]))
+    chunks = [body[i:j] for i, j in zip(cuts, cuts[1:])]
+    status_code, xml, structured_data = _read_streaming(
+      ChunkedResponse(_MULTIPART_TYPE, chunks), False)
+    self.assertEqual(status_code, 200)
+    self.assertIsNone(xml)
+    buffered = _root_part(_MULTIPART_TYPE, body)
+    self.assertEqual(buffered, root)
+    self.assertEqual(structured_data, xmltodict.parse(buffered))
+
+if __name__ == '__main__':
+  unittest.main()
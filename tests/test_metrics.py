@@ -0,0 +1,70 @@
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import requests
+
+import oncorelib
+from oncorelib.breaker import CircuitBreaker, CircuitOpenError
+from oncorelib.metrics import HistogramCollector
+from oncorelib.retry import RetryPolicy
+from tests import fakes
+
+def refuse(envelope):
+  raise requests.ConnectionError('refused')
+
+class FailedCallEventsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.events = []
+
+  def client(self, handler, **kwargs):
+    return oncorelib.Client(fakes.make_spec(),
+                            transport=fakes.FakeTransport(handler),
+                            hooks=[self.events.append], **kwargs)
+
+  def phase(self, name):
+    return [event for event in self.events if event['phase'] == name]
+
+  def test_success_has_no_error(self):
+    client = self.client(lambda envelope: (200, fakes.NO_SUBJECT_XML))
+    client.get_subject_data(u'1')
+    total, = self.phase('total')
+    self.assertEqual(total['status-code'], 200)
+    self.assertIsNone(total['error'])
+    self.assertNotIn('error', self.phase('request')[0])
+
+  def test_failed_attempts_and_call_are_reported(self):
+    policy = RetryPolicy(max_attempts=3, sleep=lambda seconds: None)
+    client = self.client(refuse, retry_policy=policy)
+    self.assertRaises(requests.ConnectionError, client.get_subject_data, u'1')
+    self.assertEqual([event['error'] for event in self.phase('request')],
+                     ['ConnectionError'] * 3)
+    total, = self.phase('total')
+    self.assertIsNone(total['status-code'])
+    self.assertIsNone(total['response-bytes'])
+    self.assertEqual(total['error'], 'ConnectionError')
+
+  def test_open_circuit_is_reported(self):
+    client = self.client(refuse,
+                         circuit_breaker=CircuitBreaker(failure_threshold=1))
+    self.assertRaises(requests.ConnectionError, client.get_subject_data, u'1')
+    self.assertRaises(CircuitOpenError, client.get_subject_data, u'1')
+    self.assertEqual([event['error'] for event in self.phase('total')],
+                     ['ConnectionError', 'CircuitOpenError'])
+    self.assertEqual(len(self.phase('request')), 1)
+
+  def test_collector_counts_errors(self):
+    collector = HistogramCollector()
+    client = oncorelib.Client(fakes.make_spec(),
+                              transport=fakes.FakeTransport(refuse),
+                              hooks=[collector])
+    self.assertRaises(requests.ConnectionError, client.call_raw,
+                      u'<x/>', 'get_subject_data')
+    calls = collector.snapshot()['calls']['get_subject_data']
+    self.assertEqual(calls['status-codes'], {None: 1})
+    self.assertEqual(calls['errors'], {'ConnectionError': 1})
+
+if __name__ == '__main__':
+  unittest.main()
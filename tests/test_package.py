@@ -0,0 +1,23 @@
+from __future__ import division
+from __future__ import print_function
+
+import types
+import unittest
+
+import oncorelib
+
+class PackageTest(unittest.TestCase):
+
+  def test_submodules_are_not_shadowed(self):
+    for name in ('batch', 'cache', 'reconcile', 'mirror', 'transport'):
+      self.assertIsInstance(getattr(oncorelib, name), types.ModuleType)
+    self.assertTrue(callable(oncorelib.reconcile.read_csv_records))
+    self.assertTrue(callable(oncorelib.reconcile_roster))
+
+  def test_modules_export_only_their_own_names(self):
+    for name in ('requests', 'json', 'time', 'threading', 'Pool', 'deque',
+                 'expat', 'sqlite3'):
+      self.assertFalse(hasattr(oncorelib, name), name)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,39 @@
+from __future__ import division
+from __future__ import print_function
+
+import time
+import unittest
+
+from oncorelib.ratelimit import RateLimiter
+
+class RateLimiterTest(unittest.TestCase):
+
+  def test_slot_wait_is_bounded_by_deadline(self):
+    limiter = RateLimiter(1000, max_in_flight=1)
+    self.assertTrue(limiter.acquire())
+    started = time.time()
+    self.assertFalse(limiter.acquire(started + 0.1))
+    self.assertLess(time.time() - started, 0.5)
+    limiter.release()
+    self.assertTrue(limiter.acquire(time.time() + 0.1))
+    limiter.release()
+
+  def test_token_wait_is_bounded_by_deadline(self):
+    sleeps = []
+    limiter = RateLimiter(1, burst=1, max_in_flight=1, sleep=sleeps.append)
+    self.assertTrue(limiter.acquire())
+    limiter.release()
+    self.assertFalse(limiter.acquire(time.time() + 0.1))
+    self.assertEqual(sleeps, [])
+    # the failed acquire gave its slot back
+    self.assertEqual(limiter._in_flight, 0)
+
+  def test_context_manager(self):
+    limiter = RateLimiter(1000, max_in_flight=2)
+    with limiter:
+      with limiter:
+        self.assertEqual(limiter._in_flight, 2)
+    self.assertEqual(limiter._in_flight, 0)
+
+if __name__ == '__main__':
+  unittest.main()